@@ -0,0 +1,223 @@
+#define _GNU_SOURCE
+#include <errno.h>
+#include <fcntl.h>
+#include <sched.h>
+#include <signal.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/prctl.h>
+#include <sys/ptrace.h>
+#include <sys/resource.h>
+#include <sys/syscall.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <linux/filter.h>
+#include <linux/seccomp.h>
+
+#ifndef PR_SET_NO_NEW_PRIVS
+#define PR_SET_NO_NEW_PRIVS 38
+#endif
+
+#define CHILD_STACK_SIZE (64 * 1024)
+
+struct gulag_rlimit {
+    int resource;
+    unsigned long soft;
+    unsigned long hard;
+};
+
+static void
+close_fds(int lowfd)
+{
+    long fd, max;
+
+#ifdef SYS_close_range
+    if (syscall(SYS_close_range, lowfd, ~0U, 0) == 0)
+        return;
+#endif
+
+    max = sysconf(_SC_OPEN_MAX);
+    for (fd = lowfd; fd < max; fd++)
+        close(fd);
+}
+
+static int
+install_filter(const struct sock_fprog *filter)
+{
+    if (prctl(PR_SET_SECCOMP, SECCOMP_MODE_FILTER, filter, 0, 0) == 0)
+        return 0;
+
+    if (errno != EACCES)
+        return -1;
+
+    if (prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0) != 0)
+        return -1;
+
+    return prctl(PR_SET_SECCOMP, SECCOMP_MODE_FILTER, filter, 0, 0);
+}
+
+struct child_args {
+    const char *path;
+    char *const *argv;
+    char *const *envp;
+    const char *cwd;
+    int fds[3];
+    const struct gulag_rlimit *limits;
+    int nlimits;
+    const char *cgroup_procs;
+    const struct sock_fprog *filter;
+    volatile int error;
+};
+
+/*
+ * runs on its own stack in our address space, only raw syscalls from here
+ * on. errno lives in the parent's thread, only error is reported back.
+ */
+static int
+child(void *arg)
+{
+    struct child_args *a = arg;
+    const int *fds = a->fds;
+    int i, fd;
+
+    for (i = 0; i < 3; i++) {
+        if (fds[i] < 0)
+            continue;
+
+        /* dup2 onto itself would keep FD_CLOEXEC */
+        if (fds[i] == i) {
+            if (fcntl(i, F_SETFD, 0) != 0)
+                goto fail;
+        } else if (dup2(fds[i], i) < 0) {
+            goto fail;
+        }
+    }
+
+    close_fds(3);
+
+    if (a->cwd && chdir(a->cwd) != 0)
+        goto fail;
+
+    if (a->cgroup_procs) {
+        fd = open(a->cgroup_procs, O_WRONLY);
+        if (fd < 0)
+            goto fail;
+        if (write(fd, "0", 1) != 1)
+            goto fail;
+        close(fd);
+    }
+
+    for (i = 0; i < a->nlimits; i++) {
+        struct rlimit rlim = {a->limits[i].soft, a->limits[i].hard};
+        if (setrlimit(a->limits[i].resource, &rlim) != 0)
+            goto fail;
+    }
+
+    if (ptrace(PTRACE_TRACEME, 0, 0, 0) != 0)
+        goto fail;
+
+    /*
+     * wait for the tracer to set its options, a SECCOMP_RET_TRACE before
+     * PTRACE_O_TRACESECCOMP would fail with ENOSYS instead of stopping.
+     * raise() would use the tid cached in the parent's thread.
+     */
+    if (kill(syscall(SYS_getpid), SIGSTOP) != 0)
+        goto fail;
+
+    if (a->filter && install_filter(a->filter) != 0)
+        goto fail;
+
+    execve(a->path, a->argv, a->envp);
+
+fail:
+    a->error = errno ? errno : EINVAL;
+    _exit(127);
+}
+
+/*
+ * returns 0 once the child is stopped at exec with options set, 1 if it
+ * has exited and been reaped, -1 if it is still there
+ */
+static int
+trace_exec(pid_t pid, int options)
+{
+    int status;
+
+    if (waitpid(pid, &status, 0) < 0)
+        return -1;
+
+    if (!WIFSTOPPED(status))
+        return 1;
+
+    if (WSTOPSIG(status) != SIGSTOP)
+        return -1;
+
+    if (ptrace(PTRACE_SETOPTIONS, pid, 0, options) != 0)
+        return -1;
+
+    for (;;) {
+        if (ptrace(PTRACE_CONT, pid, 0, 0) != 0)
+            return -1;
+
+        if (waitpid(pid, &status, 0) < 0)
+            return -1;
+
+        if (!WIFSTOPPED(status))
+            return 1;
+
+        /* the exec stop, anything else stopped on the way is let through */
+        if (WSTOPSIG(status) == SIGTRAP &&
+                (status >> 16) != PTRACE_EVENT_SECCOMP)
+            return 0;
+    }
+}
+
+pid_t
+gulag_spawn(const char *path, char *const argv[], char *const envp[],
+            const char *cwd, int stdin_fd, int stdout_fd, int stderr_fd,
+            const struct gulag_rlimit *limits, int nlimits,
+            const char *cgroup_procs, const struct sock_fprog *filter,
+            int options, int *error)
+{
+    struct child_args a = {
+        path, argv, envp, cwd, {stdin_fd, stdout_fd, stderr_fd},
+        limits, nlimits, cgroup_procs, filter, 0};
+    char *stack;
+    pid_t pid;
+    int traced;
+
+    /* unlike vfork, clone lets us run while the child waits for options */
+    stack = mmap(NULL, CHILD_STACK_SIZE, PROT_READ | PROT_WRITE,
+                 MAP_PRIVATE | MAP_ANONYMOUS | MAP_STACK, -1, 0);
+    if (stack == MAP_FAILED) {
+        *error = errno;
+        return -1;
+    }
+
+    pid = clone(child, stack + CHILD_STACK_SIZE, CLONE_VM | SIGCHLD, &a);
+
+    if (pid < 0) {
+        *error = errno;
+        munmap(stack, CHILD_STACK_SIZE);
+        return -1;
+    }
+
+    traced = trace_exec(pid, options);
+
+    if (traced != 0) {
+        *error = a.error ? a.error : errno ? errno : ECHILD;
+
+        if (traced < 0) {
+            kill(pid, SIGKILL);
+            waitpid(pid, NULL, 0);
+        }
+
+        munmap(stack, CHILD_STACK_SIZE);
+        return -1;
+    }
+
+    /* past exec the child has its own memory, the stack is ours again */
+    munmap(stack, CHILD_STACK_SIZE);
+    *error = 0;
+    return pid;
+}
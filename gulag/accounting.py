@@ -0,0 +1,118 @@
+from os import mkdir, rmdir
+from os.path import exists, join
+from resource import getpagesize
+from tempfile import mkdtemp
+
+
+PAGESIZE = getpagesize()
+
+
+def cgroup2_mount():
+    with open("/proc/mounts", "r") as f:
+        for line in f:
+            fields = line.split()
+            if fields[2] == 'cgroup2':
+                return fields[1]
+
+
+class StatmAccounting(object):
+    NAME = 'statm'
+    TRACE_MEMORY = True
+    procs = None
+
+    def __init__(self, rss_limit=None, vm_limit=None):
+        pass
+
+    def collect(self, usage):
+        return usage.ru_utime + usage.ru_stime, 0, False
+
+    def close(self):
+        pass
+
+
+class CgroupAccounting(object):
+    NAME = 'cgroup'
+    TRACE_MEMORY = False
+    CGROUP = __package__
+    CONTROLLERS = ('cpu', 'memory')
+
+    _root = None
+
+    @classmethod
+    def available(cls):
+        if cls._root is None:
+            cls._root = cls._setup() or False
+        return bool(cls._root)
+
+    @classmethod
+    def _setup(cls):
+        mount = cgroup2_mount()
+        if mount is None:
+            return
+
+        enable = " ".join("+" + c for c in cls.CONTROLLERS)
+        root = join(mount, cls.CGROUP)
+
+        try:
+            with open(join(mount, "cgroup.controllers"), "r") as f:
+                controllers = f.read().split()
+
+            if not all(c in controllers for c in cls.CONTROLLERS):
+                return
+
+            with open(join(mount, "cgroup.subtree_control"), "w") as f:
+                f.write(enable)
+
+            if not exists(root):
+                mkdir(root)
+
+            with open(join(root, "cgroup.subtree_control"), "w") as f:
+                f.write(enable)
+        except (IOError, OSError):
+            return
+
+        # memory.peak is only there since linux 5.19
+        if not exists(join(root, "memory.peak")):
+            return
+
+        return root
+
+    def __init__(self, rss_limit=None, vm_limit=None):
+        assert self.available(), "cgroup v2 is not available"
+        self._path = mkdtemp(prefix="run.", dir=self._root)
+        self.procs = join(self._path, "cgroup.procs")
+
+        if rss_limit is not None:
+            self._write("memory.max", rss_limit * PAGESIZE)
+
+            if exists(join(self._path, "memory.swap.max")):
+                self._write("memory.swap.max", 0)
+
+    def _write(self, name, value):
+        with open(join(self._path, name), "w") as f:
+            f.write(str(value))
+
+    def _read(self, name):
+        with open(join(self._path, name), "r") as f:
+            return f.read()
+
+    def _read_keyed(self, name):
+        return dict(
+            (key, int(value))
+            for key, value in (
+                line.split() for line in self._read(name).splitlines()))
+
+    def collect(self, usage):
+        cputime = self._read_keyed("cpu.stat")["usage_usec"] / 1e6
+        maxrss = int(self._read("memory.peak")) // PAGESIZE
+        oom = self._read_keyed("memory.events").get("oom_kill", 0) > 0
+        return cputime, maxrss, oom
+
+    def close(self):
+        rmdir(self._path)
+
+
+def default_accounting():
+    if CgroupAccounting.available():
+        return CgroupAccounting
+    return StatmAccounting
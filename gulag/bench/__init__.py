@@ -0,0 +1,336 @@
+from argparse import ArgumentParser
+import json
+import os
+from os import devnull, listdir, unlink
+from os.path import dirname, join, splitext
+import platform
+from shutil import rmtree
+from subprocess import PIPE, check_call
+import sys
+from tempfile import NamedTemporaryFile, mkdtemp
+from time import time
+
+from ..ptrace import PTracedProcess
+from ..spawn import load
+from ..summary import summarize as _summarize
+from ..verdict import verdictcode
+
+
+PROGRAMS_DIR = join(dirname(__file__), 'programs')
+
+
+class ChunkedProcess(PTracedProcess):
+
+    def _map_expected(self, fd, compare):
+        return (self._compare_stdout, compare)
+
+
+def count_stops(args, seccomp, times=10, time_limit=10):
+    stops = 0
+
+    for i in xrange(times):
+        with open(devnull, 'rb') as stdin:
+            p = PTracedProcess(
+                args, stdin=stdin, stdout=PIPE, stderr=PIPE,
+                time_limit=time_limit, seccomp=seccomp)
+
+        p.communicate()
+        stops += p.stats.stops
+
+    return float(stops) / times
+
+
+def compare_throughput(args, filename, process=PTracedProcess,
+                       times=3, time_limit=60):
+    elapsed = 0.0
+
+    for i in xrange(times):
+        with open(devnull, 'rb') as stdin:
+            p = process(
+                args, stdin=stdin, stdout=PIPE,
+                time_limit=time_limit)
+
+        with open(filename, 'rb') as compare:
+            start = time()
+            p.communicate(compare_stdout=compare)
+            elapsed += time() - start
+
+        assert p.verdict is not None
+
+    return elapsed / times
+
+
+def spawn_latency(args, fast_spawn, times=100, time_limit=10):
+    elapsed = 0.0
+
+    for i in xrange(times):
+        with open(devnull, 'rb') as stdin:
+            start = time()
+            p = PTracedProcess(
+                args, stdin=stdin, stdout=PIPE, stderr=PIPE,
+                time_limit=time_limit, fast_spawn=fast_spawn)
+            elapsed += time() - start
+
+        p.communicate()
+
+    return elapsed / times
+
+
+def summarize(samples):
+    return dict(_summarize(samples)._asdict())
+
+
+def build_programs(outdir, compiler='gcc'):
+    programs = {}
+
+    for name in sorted(listdir(PROGRAMS_DIR)):
+        base, ext = splitext(name)
+        if ext != '.c':
+            continue
+
+        target = join(outdir, base)
+        check_call(
+            [compiler, '-O2', '-o', target, join(PROGRAMS_DIR, name)])
+        programs[base] = target
+
+    return programs
+
+
+def write_pattern(filename, size):
+    # the same bytes programs/output.c writes
+    block = ''.join(
+        '\n' if i % 64 == 63 else chr(ord('a') + i % 26)
+        for i in xrange(1 << 16))
+
+    with open(filename, 'wb') as f:
+        for i in xrange(0, size, len(block)):
+            f.write(block)
+
+
+def trace_program(args, stdin_path=devnull, times=5, time_limit=10,
+                  **kwargs):
+    walls = []
+    stops = []
+    verdicts = set()
+
+    for i in xrange(times):
+        with open(stdin_path, 'rb') as stdin:
+            start = time()
+            p = PTracedProcess(
+                args, stdin=stdin, stdout=PIPE, stderr=PIPE,
+                time_limit=time_limit, **kwargs)
+            p.communicate()
+            walls.append(time() - start)
+
+        stops.append(p.stats.stops)
+        verdicts.add(verdictcode[p.verdict])
+
+    wall = summarize(walls)
+    return {
+        'wall': wall,
+        'stops': float(sum(stops)) / times,
+        'stops_per_second': sum(stops) / sum(walls),
+        'verdicts': sorted(verdicts),
+    }
+
+
+def bench_tracer(programs, workdir, times):
+    io_input = join(workdir, 'io.in')
+    with open(io_input, 'wb') as f:
+        f.write('x' * (1 << 16))
+
+    cases = [
+        ('io', [programs['io']], io_input),
+        ('mmap', [programs['mmap']], devnull),
+        ('output', [programs['output'], '16'], devnull),
+        ('fork', [programs['fork']], devnull),
+        ('sleep', [programs['sleep']], devnull),
+    ]
+
+    results = {}
+
+    for name, args, stdin_path in cases:
+        results[name] = {}
+        for mode, seccomp in (('syscall', False), ('seccomp', True)):
+            results[name][mode] = trace_program(
+                args, stdin_path, times, seccomp=seccomp)
+
+    return results
+
+
+def bench_comparison(programs, workdir, size=64):
+    expected = join(workdir, 'output.out')
+    write_pattern(expected, size << 20)
+    args = [programs['output'], str(size)]
+
+    chunked = compare_throughput(args, expected, ChunkedProcess)
+    mapped = compare_throughput(args, expected)
+
+    return {
+        'size_mb': size,
+        'chunked_mb_per_second': size / chunked,
+        'mapped_mb_per_second': size / mapped,
+    }
+
+
+def bench_spawn_latency(times):
+    results = {'fork': spawn_latency(['/bin/true'], False, times)}
+
+    if load() is not None:
+        results['clone_vm'] = spawn_latency(['/bin/true'], True, times)
+
+    return results
+
+
+def bench_selinux(workdir, times, compile_level, run_level):
+    from ..gcc import GCCMixin
+    from ..judge import Judge
+    from ..runner import Runner
+
+    class BenchRunner(GCCMixin, Runner):
+        COMPILE_LEVEL = compile_level
+        RUN_LEVEL = run_level
+
+    src = join(PROGRAMS_DIR, 'io.c')
+    input_filename = join(workdir, 'io.in')
+    expected_filename = join(workdir, 'io.out')
+    with open(expected_filename, 'wb') as f:
+        f.write('x' * (1 << 16))
+
+    walls = []
+
+    with BenchRunner(src) as r:
+        result = r.compile(['-O2'])
+        assert result[0] == os.EX_OK, result
+
+        for i in xrange(times):
+            start = time()
+            r.run(
+                stdin=r.open(input_filename, 'rb'),
+                stdout=r.open(expected_filename, 'rb'),
+                time_limit=10)
+            walls.append(time() - start)
+
+    judge = Judge({'gcc': BenchRunner}, {})
+    result = judge.benchmark(
+        'gcc -O2', src, (input_filename, expected_filename),
+        times=times, warmup=1)
+
+    return {
+        'runner_run_wall': summarize(walls),
+        'judge_benchmark_cputime': dict(result.cputime._asdict()),
+    }
+
+
+def run_suite(times=5, selinux=True, compile_level='s0', run_level='s0'):
+    workdir = mkdtemp(prefix="." + __package__)
+
+    try:
+        programs = build_programs(workdir)
+        results = {
+            'machine': platform.machine(),
+            'kernel': platform.release(),
+            'python': platform.python_version(),
+            'time': time(),
+            'tracer': bench_tracer(programs, workdir, times),
+            'comparison': bench_comparison(programs, workdir),
+            'spawn_latency': bench_spawn_latency(times * 20),
+        }
+
+        if selinux:
+            try:
+                results['selinux'] = bench_selinux(
+                    workdir, times, compile_level, run_level)
+            except (ImportError, AssertionError) as e:
+                results['selinux'] = {'skipped': str(e)}
+        else:
+            results['selinux'] = {'skipped': "disabled"}
+
+        return results
+    finally:
+        rmtree(workdir, True)
+
+
+def bench_suite(args):
+    parser = ArgumentParser(prog="python -m gulag.bench suite")
+    parser.add_argument('-o', '--output', default='-')
+    parser.add_argument('-n', '--times', type=int, default=5)
+    parser.add_argument('--no-selinux', action='store_true')
+    parser.add_argument('--compile-level', default='s0')
+    parser.add_argument('--run-level', default='s0')
+    opts = parser.parse_args(args)
+
+    results = run_suite(
+        opts.times, not opts.no_selinux,
+        opts.compile_level, opts.run_level)
+
+    if opts.output == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+def bench_stops(args):
+    syscall = count_stops(args, False)
+    seccomp = count_stops(args, True)
+
+    print "ptrace stops per run"
+    print "  PTRACE_SYSCALL: %10.1f" % syscall
+    print "  seccomp:        %10.1f" % seccomp
+    print "  saved:          %10.1f" % (syscall - seccomp)
+
+
+def bench_compare(args):
+    size = int(args[0]) if args else 100
+
+    with NamedTemporaryFile(delete=False) as f:
+        line = "%s\n" % ("0123456789" * 7)
+        f.write(line * (size * (1 << 20) / len(line)))
+
+    try:
+        cat = ['/bin/cat', f.name]
+        chunked = compare_throughput(cat, f.name, ChunkedProcess)
+        mapped = compare_throughput(cat, f.name)
+    finally:
+        unlink(f.name)
+
+    print "stdout comparison throughput, %d MB" % size
+    print "  4096 byte reads: %10.1f MB/s" % (size / chunked)
+    print "  mmap:            %10.1f MB/s" % (size / mapped)
+
+
+def bench_spawn(args):
+    args = args or ['/bin/true']
+
+    if load() is None:
+        print >>sys.stderr, "the fast spawn helper is not built"
+        return 1
+
+    fork = spawn_latency(args, False)
+    clone_vm = spawn_latency(args, True)
+
+    print "spawn latency, until the initial ptrace stop"
+    print "  fork + exec:            %8.3f ms" % (fork * 1000)
+    print "  clone(CLONE_VM) helper: %8.3f ms" % (clone_vm * 1000)
+
+
+BENCHMARKS = {
+    'stops': (bench_stops, "PROGRAM [ARGS...]"),
+    'compare': (bench_compare, "[SIZE_MB]"),
+    'spawn': (bench_spawn, "[PROGRAM [ARGS...]]"),
+    'suite': (bench_suite, "[-o FILE] [-n TIMES] [--no-selinux]"),
+}
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+
+    if not args or args[0] not in BENCHMARKS:
+        for name, (_, usage) in sorted(BENCHMARKS.items()):
+            print >>sys.stderr, "usage: python -m gulag.bench %s %s" % (
+                name, usage)
+        return 2
+
+    return BENCHMARKS[args[0]][0](args[1:])
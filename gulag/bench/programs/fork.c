@@ -0,0 +1,22 @@
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+int
+main(void)
+{
+    int i, forked = 0;
+    pid_t pid;
+
+    for (i = 0; i < 1000; i++) {
+        pid = fork();
+        if (pid == 0)
+            _exit(0);
+        if (pid > 0) {
+            forked++;
+            waitpid(pid, 0, 0);
+        }
+    }
+
+    return forked;
+}
@@ -0,0 +1,19 @@
+#include <sys/mman.h>
+
+int
+main(void)
+{
+    int i;
+    char *p;
+
+    for (i = 0; i < 20000; i++) {
+        p = mmap(0, 1 << 16, PROT_READ | PROT_WRITE,
+                 MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+        if (p == MAP_FAILED)
+            return 1;
+        p[0] = p[(1 << 16) - 1] = 1;
+        munmap(p, 1 << 16);
+    }
+
+    return 0;
+}
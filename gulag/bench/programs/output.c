@@ -0,0 +1,20 @@
+#include <stdlib.h>
+#include <unistd.h>
+
+#define BLOCK (1 << 16)
+
+int
+main(int argc, char *argv[])
+{
+    static char buf[BLOCK];
+    long i, size = (argc > 1 ? atol(argv[1]) : 64) << 20;
+
+    for (i = 0; i < BLOCK; i++)
+        buf[i] = (i % 64 == 63) ? '\n' : 'a' + i % 26;
+
+    for (i = 0; i < size; i += BLOCK)
+        if (write(1, buf, BLOCK) != BLOCK)
+            return 1;
+
+    return 0;
+}
@@ -0,0 +1,13 @@
+#include <time.h>
+
+int
+main(void)
+{
+    int i;
+    struct timespec ts = {0, 10000000};
+
+    for (i = 0; i < 20; i++)
+        nanosleep(&ts, 0);
+
+    return 0;
+}
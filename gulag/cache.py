@@ -0,0 +1,145 @@
+from hashlib import sha256
+import os
+from os.path import exists, getsize, join
+from shutil import copy, rmtree
+from subprocess import Popen, PIPE, STDOUT
+from tempfile import mkdtemp
+
+
+_versions = {}
+
+
+def compiler_version(executable):
+    mtime = os.stat(executable).st_mtime
+    version = _versions.get(executable)
+
+    if version is None or version[0] != mtime:
+        p = Popen(
+            [executable, '--version'], stdout=PIPE, stderr=STDOUT,
+            close_fds=True)
+        version = (mtime, p.communicate()[0])
+        _versions[executable] = version
+
+    return version[1]
+
+
+class CompileCache(object):
+    LOW_WATER = 0.9
+
+    def __init__(self, path, max_size=1 << 30):
+        self._path = path
+        self._max_size = max_size
+        self._size = None
+
+        if not exists(path):
+            os.makedirs(path)
+
+    def compiler_version(self, executable):
+        return compiler_version(executable)
+
+    def key(self, src_path, executable, args):
+        h = sha256()
+
+        with open(src_path, 'rb') as f:
+            source = f.read()
+
+        for part in [source, executable,
+                     self.compiler_version(executable)] + list(args):
+            h.update("%d:" % len(part))
+            h.update(part)
+
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return join(self._path, key[:2], key)
+
+    def get(self, key):
+        entry = self._entry(key)
+
+        try:
+            with open(join(entry, 'result'), 'rb') as f:
+                code = int(f.readline())
+                output = f.read()
+            os.utime(entry, None)
+        except (IOError, OSError):
+            return None
+
+        return code, output, join(entry, 'target')
+
+    def put(self, key, code, output, target=None):
+        entry = self._entry(key)
+        parent = join(self._path, key[:2])
+
+        if not exists(parent):
+            try:
+                os.mkdir(parent)
+            except OSError:
+                pass
+
+        tempdir = mkdtemp(prefix='.', dir=parent)
+
+        with open(join(tempdir, 'result'), 'wb') as f:
+            f.write("%d\n" % code)
+            f.write(output)
+
+        if target is not None:
+            copy(target, join(tempdir, 'target'))
+
+        size = sum(getsize(join(tempdir, f)) for f in os.listdir(tempdir))
+
+        try:
+            os.rename(tempdir, entry)
+        except OSError:
+            rmtree(tempdir, True)
+            return
+
+        # only walk the whole cache once it may have grown too big
+        if self._size is None or self._size + size > self._max_size:
+            self.evict()
+        else:
+            self._size += size
+
+    def evict(self):
+        entries = []
+        total = 0
+
+        for prefix in os.listdir(self._path):
+            parent = join(self._path, prefix)
+
+            for name in os.listdir(parent):
+                if name.startswith('.'):
+                    continue
+
+                entry = join(parent, name)
+
+                try:
+                    size = sum(
+                        getsize(join(entry, f)) for f in os.listdir(entry))
+                    mtime = os.stat(entry).st_mtime
+                except OSError:
+                    continue
+
+                entries.append((mtime, size, entry))
+                total += size
+
+        if total <= self._max_size:
+            self._size = total
+            return
+
+        entries.sort()
+
+        # evict a bit more than needed so puts don't walk the cache each time
+        for mtime, size, entry in entries:
+            if total <= self._max_size * self.LOW_WATER:
+                break
+
+            rmtree(entry, True)
+            total -= size
+
+        self._size = total
+
+    def invalidate(self):
+        self._size = None
+
+        for prefix in os.listdir(self._path):
+            rmtree(join(self._path, prefix), True)
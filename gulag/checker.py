@@ -0,0 +1,138 @@
+import re
+from zlib import crc32
+
+from .verdict import AC, PE, WA
+
+
+WHITESPACE = re.compile(r'\s+')
+
+
+class Tokenizer(object):
+    # each token is paired with a (crc32, length) signature of the
+    # whitespace before it, so whitespace can be compared in O(1) memory
+
+    def __init__(self, max_token=1 << 24):
+        self._max_token = max_token
+        self._token = []
+        self._token_len = 0
+        self._crc = 0
+        self._len = 0
+
+    def _emit(self, tokens):
+        tokens.append(((self._crc, self._len), ''.join(self._token)))
+        self._token = []
+        self._token_len = 0
+        self._crc = 0
+        self._len = 0
+
+    def _append(self, piece):
+        self._token.append(piece)
+        self._token_len += len(piece)
+
+        if self._token_len > self._max_token:
+            raise ValueError("token too long")
+
+    def feed(self, data):
+        tokens = []
+        pos = 0
+
+        for m in WHITESPACE.finditer(data):
+            start, end = m.span()
+
+            if start > pos:
+                self._append(data[pos:start])
+
+            if self._token:
+                self._emit(tokens)
+
+            self._crc = crc32(m.group(), self._crc)
+            self._len += end - start
+            pos = end
+
+        if pos < len(data):
+            self._append(data[pos:])
+
+        return tokens
+
+    def finish(self):
+        tokens = []
+
+        if self._token:
+            self._emit(tokens)
+
+        return tokens, (self._crc, self._len)
+
+
+def read_tokens(f, blocksize=1 << 16, max_token=1 << 24):
+    tokenizer = Tokenizer(max_token)
+
+    for data in iter(lambda: f.read(blocksize), ''):
+        for token in tokenizer.feed(data):
+            yield token
+
+    tokens, trailing = tokenizer.finish()
+
+    for token in tokens:
+        yield token
+
+    yield trailing, None
+
+
+class TokenChecker(object):
+
+    def __init__(self, expected, float_tolerance=None, max_token=1 << 24):
+        self._expected = read_tokens(expected, max_token=max_token)
+        self._output = Tokenizer(max_token)
+        self._float_tolerance = float_tolerance
+        self.presentation_error = False
+
+    def _match(self, output, expected):
+        if output == expected:
+            return True
+
+        if expected is None or self._float_tolerance is None:
+            return False
+
+        try:
+            a, b = float(output), float(expected)
+        except ValueError:
+            return False
+
+        return abs(a - b) <= self._float_tolerance * max(1.0, abs(b))
+
+    def _check(self, tokens):
+        for sep, token in tokens:
+            expected_sep, expected = next(self._expected)
+
+            if not self._match(token, expected):
+                return False
+
+            if sep != expected_sep:
+                self.presentation_error = True
+
+        return True
+
+    def feed(self, data):
+        try:
+            return self._check(self._output.feed(data))
+        except ValueError:
+            return False
+
+    def finish(self):
+        try:
+            tokens, trailing = self._output.finish()
+
+            if not self._check(tokens):
+                return WA
+
+            expected_trailing, expected = next(self._expected)
+        except ValueError:
+            return WA
+
+        if expected is not None:
+            return WA
+
+        if trailing != expected_trailing:
+            self.presentation_error = True
+
+        return PE if self.presentation_error else AC
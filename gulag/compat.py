@@ -1,14 +1,16 @@
 import platform
 
 from ctypes import (
-    cdll, sizeof, POINTER, Structure,
-    c_short, c_ulong, c_long, c_int, c_void_p,
-    c_uint8, c_int32, c_uint32, c_uint64)
+    CDLL, addressof, byref, create_string_buffer, get_errno, sizeof,
+    POINTER, Structure, string_at,
+    c_short, c_ushort, c_ulong, c_long, c_int, c_size_t, c_ssize_t,
+    c_void_p, c_uint8, c_uint16, c_int32, c_uint32, c_uint64)
 from ctypes.util import find_library
-from os import O_CREAT, O_RDWR, O_WRONLY
+from errno import EACCES, ENOSYS
+from os import O_CREAT, O_RDWR, O_TRUNC, O_WRONLY, strerror
 
 
-libc = cdll.LoadLibrary(find_library('c'))
+libc = CDLL(find_library('c'), use_errno=True)
 
 
 class signalfd_siginfo(Structure):
@@ -31,6 +33,40 @@ class signalfd_siginfo(Structure):
         ('ssi_addr',    c_uint64),
         ('_padding',    c_uint8 * 48))
 
+F_SETPIPE_SZ = 1031
+
+
+class timespec(Structure):
+    _fields_ = (
+        ('tv_sec',  c_long),
+        ('tv_nsec', c_long))
+
+
+class itimerspec(Structure):
+    _fields_ = (
+        ('it_interval', timespec),
+        ('it_value',    timespec))
+
+CLOCK_MONOTONIC = 1
+TFD_NONBLOCK = 0o4000
+TFD_CLOEXEC = 0o2000000
+
+timerfd_create = libc.timerfd_create
+timerfd_create.argtypes = [c_int, c_int]
+timerfd_create.restype = c_int
+
+timerfd_settime = libc.timerfd_settime
+timerfd_settime.argtypes = [
+    c_int, c_int, POINTER(itimerspec), POINTER(itimerspec)]
+timerfd_settime.restype = c_int
+
+
+def set_timer(fd, interval):
+    sec = int(interval)
+    nsec = int((interval - sec) * 1e9)
+    spec = itimerspec(timespec(sec, nsec), timespec(sec, nsec))
+    return timerfd_settime(fd, 0, spec, None)
+
 SIG_BLOCK = 0
 SIG_UNBLOCK = 1
 SIG_SETMASK = 2
@@ -50,17 +86,84 @@ sigprocmask = libc.sigprocmask
 sigprocmask.argtypes = [c_int, POINTER(sigset_t), POINTER(sigset_t)]
 sigprocmask.restype = c_int
 
+
+def block_signals(signals):
+    mask = sigset_t()
+    sigemptyset(mask)
+    for sig in signals:
+        sigaddset(mask, sig)
+
+    if sigprocmask(SIG_BLOCK, mask, None) != 0:
+        errno = get_errno()
+        raise OSError(errno, strerror(errno))
+
+
 signalfd = libc.signalfd
 signalfd.argtypes = [c_int, POINTER(sigset_t), c_int]
 signalfd.restype = c_int
 
+_CPU_SETSIZE = 1024
+_NCPUBITS = 8 * sizeof(c_ulong)
+cpu_set_t = c_ulong * (_CPU_SETSIZE / _NCPUBITS)
+
+sched_setaffinity = libc.sched_setaffinity
+sched_setaffinity.argtypes = [c_int, c_size_t, POINTER(cpu_set_t)]
+sched_setaffinity.restype = c_int
+
+sched_getaffinity = libc.sched_getaffinity
+sched_getaffinity.argtypes = [c_int, c_size_t, POINTER(cpu_set_t)]
+sched_getaffinity.restype = c_int
+
+
+def get_affinity(pid):
+    mask = cpu_set_t()
+    if sched_getaffinity(pid, sizeof(mask), mask) != 0:
+        errno = get_errno()
+        raise OSError(errno, strerror(errno))
+
+    return [
+        cpu for cpu in xrange(_CPU_SETSIZE)
+        if mask[cpu / _NCPUBITS] & (1 << (cpu % _NCPUBITS))]
+
+
+def set_affinity(pid, cpus):
+    mask = cpu_set_t()
+    for cpu in cpus:
+        mask[cpu / _NCPUBITS] |= 1 << (cpu % _NCPUBITS)
+
+    if sched_setaffinity(pid, sizeof(mask), mask) != 0:
+        errno = get_errno()
+        raise OSError(errno, strerror(errno))
+
+
 ptrace = libc.ptrace
 ptrace.argtypes = [c_short, c_int, c_int, c_void_p]
 ptrace.restype = c_long
 
 PTRACE_TRACEME = 0
 PTRACE_PEEKUSER = 3
+PTRACE_CONT = 7
+PTRACE_GETREGS = 12
+PTRACE_SETREGS = 13
 PTRACE_SYSCALL = 24
+PTRACE_SETOPTIONS = 0x4200
+PTRACE_GETEVENTMSG = 0x4201
+PTRACE_GETSIGINFO = 0x4202
+
+PTRACE_O_TRACESYSGOOD = 0x01
+PTRACE_O_TRACECLONE = 0x08
+PTRACE_O_TRACEEXEC = 0x10
+PTRACE_O_TRACEEXIT = 0x40
+PTRACE_O_TRACESECCOMP = 0x80
+PTRACE_EVENT_CLONE = 3
+PTRACE_EVENT_EXEC = 4
+PTRACE_EVENT_EXIT = 6
+PTRACE_EVENT_SECCOMP = 7
+
+# __WALL, wait for threads as well as processes
+WALL = 0x40000000
+
+CLONE_THREAD = 0x00010000
 
 
 def traceme():
@@ -71,21 +174,217 @@ def trap_syscall(pid):
     return ptrace(PTRACE_SYSCALL, pid, 0, None)
 
 
+def cont(pid):
+    return ptrace(PTRACE_CONT, pid, 0, None)
+
+
+def set_options(pid, options):
+    return ptrace(PTRACE_SETOPTIONS, pid, 0, options)
+
+
+def get_event_msg(pid):
+    msg = c_ulong()
+    if ptrace(PTRACE_GETEVENTMSG, pid, 0, byref(msg)) != 0:
+        errno = get_errno()
+        raise OSError(errno, strerror(errno))
+    return msg.value
+
+
+# the head of siginfo_t, with the kill() fields of the union
+class siginfo_t(Structure):
+    _fields_ = (
+        ('si_signo', c_int32),
+        ('si_errno', c_int32),
+        ('si_code',  c_int32),
+        ('_pad',     c_int32),
+        ('si_pid',   c_int32),
+        ('si_uid',   c_uint32),
+        ('_rest',    c_uint8 * 104))
+
+SI_USER = 0
+
+
+def get_siginfo(pid, info):
+    if ptrace(PTRACE_GETSIGINFO, pid, 0, byref(info)) != 0:
+        errno = get_errno()
+        raise OSError(errno, strerror(errno))
+
+
+def get_regs(pid, regs):
+    if ptrace(PTRACE_GETREGS, pid, 0, byref(regs)) != 0:
+        errno = get_errno()
+        raise OSError(errno, strerror(errno))
+
+
+def set_regs(pid, regs):
+    if ptrace(PTRACE_SETREGS, pid, 0, byref(regs)) != 0:
+        errno = get_errno()
+        raise OSError(errno, strerror(errno))
+
+
+class iovec(Structure):
+    _fields_ = (
+        ('iov_base', c_void_p),
+        ('iov_len',  c_size_t))
+
+process_vm_readv = libc.process_vm_readv
+process_vm_readv.argtypes = [
+    c_int, POINTER(iovec), c_ulong, POINTER(iovec), c_ulong, c_ulong]
+process_vm_readv.restype = c_ssize_t
+
+PATH_MAX = 4096
+
+
+class StringReader(object):
+
+    def __init__(self, size=PATH_MAX):
+        self._buf = create_string_buffer(size)
+        self._local = iovec(addressof(self._buf), size)
+        self._remote = iovec(None, size)
+
+    def read(self, pid, addr):
+        # a single read, it may stop short at the end of a mapping
+        self._remote.iov_base = addr
+        n = process_vm_readv(pid, self._local, 1, self._remote, 1, 0)
+
+        if n <= 0:
+            return None
+
+        data = string_at(self._buf, n)
+        end = data.find('\0')
+        if end < 0:
+            return None
+
+        return data[:end]
+
+
+class FrameReader(object):
+    # a frame is the caller's frame pointer followed by the return address
+
+    def __init__(self):
+        self._frame = (c_ulong * 2)()
+        self._local = iovec(addressof(self._frame), sizeof(self._frame))
+        self._remote = iovec(None, sizeof(self._frame))
+
+    def walk(self, pid, fp, depth):
+        pcs = []
+
+        while fp and len(pcs) < depth:
+            self._remote.iov_base = fp
+            n = process_vm_readv(pid, self._local, 1, self._remote, 1, 0)
+
+            if n != sizeof(self._frame):
+                break
+
+            next_fp, pc = self._frame
+            if not pc:
+                break
+
+            pcs.append(pc)
+
+            # the stack grows down, anything else is not a saved frame
+            if next_fp <= fp:
+                break
+
+            fp = next_fp
+
+        return pcs
+
+
+prctl = libc.prctl
+prctl.argtypes = [c_int, c_ulong, c_void_p, c_ulong, c_ulong]
+prctl.restype = c_int
+
+PR_SET_NO_NEW_PRIVS = 38
+PR_SET_SECCOMP = 22
+SECCOMP_MODE_FILTER = 2
+
+SECCOMP_RET_KILL = 0x00000000
+SECCOMP_RET_ERRNO = 0x00050000
+SECCOMP_RET_TRACE = 0x7ff00000
+SECCOMP_RET_ALLOW = 0x7fff0000
+
+BPF_LD_W_ABS = 0x20
+BPF_JEQ_K = 0x15
+BPF_JGE_K = 0x35
+BPF_RET_K = 0x06
+
+
+class sock_filter(Structure):
+    _fields_ = (
+        ('code', c_uint16),
+        ('jt',   c_uint8),
+        ('jf',   c_uint8),
+        ('k',    c_uint32))
+
+
+class sock_fprog(Structure):
+    _fields_ = (
+        ('len',    c_ushort),
+        ('filter', POINTER(sock_filter)))
+
+
+def install_filter(prog):
+    if prctl(PR_SET_SECCOMP, SECCOMP_MODE_FILTER, byref(prog), 0, 0) == 0:
+        return
+
+    errno = get_errno()
+
+    # without CAP_SYS_ADMIN, the kernel insists on no_new_privs
+    if errno == EACCES:
+        prctl(PR_SET_NO_NEW_PRIVS, 1, None, 0, 0)
+        if prctl(PR_SET_SECCOMP, SECCOMP_MODE_FILTER,
+                 byref(prog), 0, 0) == 0:
+            return
+        errno = get_errno()
+
+    raise OSError(errno, strerror(errno))
+
+
 machine = platform.machine()
 
 if machine == 'x86_64':
-    # RAX = syscall(ORIG_RAX, RDI, RSI, RDX, RCX, ...)
-    RAX = 10
-    RCX = 11
-    RDX = 12
-    RSI = 13
-    RDI = 14
-    ORIG_RAX = 15
+    # rax = syscall(orig_rax, rdi, rsi, rdx, r10, r8, r9)
+    class user_regs_struct(Structure):
+        _fields_ = [(name, c_ulong) for name in (
+            'r15', 'r14', 'r13', 'r12', 'rbp', 'rbx', 'r11', 'r10',
+            'r9', 'r8', 'rax', 'rcx', 'rdx', 'rsi', 'rdi', 'orig_rax',
+            'rip', 'cs', 'eflags', 'rsp', 'ss', 'fs_base', 'gs_base',
+            'ds', 'es', 'fs', 'gs')]
 
     SYS_open = 2
     SYS_socket = 41
     SYS_creat = 85
     SYS_openat = 257
+    SYS_openat2 = 437
+
+    SYS_truncate = 76
+    SYS_rename = 82
+    SYS_mkdir = 83
+    SYS_rmdir = 84
+    SYS_unlink = 87
+    SYS_chmod = 90
+    SYS_chown = 92
+    SYS_lchown = 94
+    SYS_mknod = 133
+    SYS_mkdirat = 258
+    SYS_mknodat = 259
+    SYS_fchownat = 260
+    SYS_unlinkat = 263
+    SYS_renameat = 264
+    SYS_fchmodat = 268
+    SYS_renameat2 = 316
+    SYS_fchmodat2 = 452
+
+    SYS_link = 86
+    SYS_symlink = 88
+    SYS_linkat = 265
+    SYS_symlinkat = 266
+
+    SYS_clone = 56
+    SYS_fork = 57
+    SYS_vfork = 58
+    SYS_clone3 = 435
 
     SYS_mmap = 9
     SYS_munmap = 11
@@ -97,18 +396,105 @@ if machine == 'x86_64':
         SYS_open, SYS_socket, SYS_creat, SYS_openat]
     MMAP_SYSCALLS = [
         SYS_mmap, SYS_munmap, SYS_brk, SYS_mremap, SYS_remap_file_pages]
+    CLONE_SYSCALLS = [SYS_clone, SYS_fork, SYS_vfork]
+    # a new link could point a checked path somewhere else
+    LINK_SYSCALLS = [SYS_link, SYS_symlink, SYS_linkat, SYS_symlinkat]
+    # clone3 and openat2 hide their flags in memory, fail them so libc
+    # falls back to clone and openat
+    ENOSYS_SYSCALLS = [SYS_clone3, SYS_openat2]
+
+    # (dirfd, path, follow) registers of the syscalls that change a path
+    # other than by opening it, dirfd None for AT_FDCWD
+    PATH_SYSCALLS = {
+        SYS_truncate:   ((None, 'rdi', True),),
+        SYS_rename:     ((None, 'rdi', False), (None, 'rsi', False)),
+        SYS_mkdir:      ((None, 'rdi', False),),
+        SYS_rmdir:      ((None, 'rdi', False),),
+        SYS_unlink:     ((None, 'rdi', False),),
+        SYS_chmod:      ((None, 'rdi', True),),
+        SYS_chown:      ((None, 'rdi', True),),
+        SYS_lchown:     ((None, 'rdi', False),),
+        SYS_mknod:      ((None, 'rdi', False),),
+        SYS_mkdirat:    (('rdi', 'rsi', False),),
+        SYS_mknodat:    (('rdi', 'rsi', False),),
+        SYS_fchownat:   (('rdi', 'rsi', True),),
+        SYS_unlinkat:   (('rdi', 'rsi', False),),
+        SYS_renameat:   (('rdi', 'rsi', False), ('rdx', 'r10', False)),
+        SYS_fchmodat:   (('rdi', 'rsi', True),),
+        SYS_renameat2:  (('rdi', 'rsi', False), ('rdx', 'r10', False)),
+        SYS_fchmodat2:  (('rdi', 'rsi', True),)}
+
+    AUDIT_ARCH = 0xc000003e
+    X32_SYSCALL_BIT = 0x40000000
+
+    def seccomp_filter(syscalls, enosys=()):
+        # struct seccomp_data { int nr; __u32 arch; ... }
+        n = len(syscalls)
+        m = len(enosys)
+        insns = [
+            (BPF_LD_W_ABS, 0, 0, 4),
+            (BPF_JEQ_K, 0, m + n + 5, AUDIT_ARCH),
+            (BPF_LD_W_ABS, 0, 0, 0),
+            (BPF_JGE_K, m + n + 3, 0, X32_SYSCALL_BIT)]
+        insns.extend(
+            (BPF_JEQ_K, m + n + 1 - i, 0, num)
+            for i, num in enumerate(enosys))
+        insns.extend(
+            (BPF_JEQ_K, n - i, 0, num)
+            for i, num in enumerate(syscalls))
+        insns.extend([
+            (BPF_RET_K, 0, 0, SECCOMP_RET_ALLOW),
+            (BPF_RET_K, 0, 0, SECCOMP_RET_TRACE),
+            (BPF_RET_K, 0, 0, SECCOMP_RET_ERRNO | ENOSYS),
+            (BPF_RET_K, 0, 0, SECCOMP_RET_KILL)])
+
+        return sock_fprog(len(insns), (sock_filter * len(insns))(*insns))
+
+    def get_syscall_number(regs):
+        return regs.orig_rax
+
+    def get_syscall_result(regs):
+        return c_long(regs.rax).value
+
+    def get_frame(regs):
+        # (pc, sp, fp) of a thread stopped in user space
+        return regs.rip, regs.rsp, regs.rbp
+
+    AT_FDCWD = -100
+    WRITE_FLAGS = O_WRONLY | O_RDWR | O_CREAT | O_TRUNC
+
+    def open_args(regs):
+        # (dirfd, pathname, write) of an open-family syscall
+        if regs.orig_rax == SYS_open:
+            return AT_FDCWD, regs.rdi, bool(regs.rsi & WRITE_FLAGS)
+        elif regs.orig_rax == SYS_openat:
+            return (c_int(regs.rdi).value, regs.rsi,
+                    bool(regs.rdx & WRITE_FLAGS))
+        elif regs.orig_rax == SYS_creat:
+            return AT_FDCWD, regs.rdi, True
+
+    def skip_syscall(pid, regs):
+        # at entry, syscall -1 is not run and returns -ENOSYS
+        regs.orig_rax = c_ulong(-1).value
+        set_regs(pid, regs)
 
-    def get_syscall_number(pid):
-        return ptrace(PTRACE_PEEKUSER, pid, 8 * ORIG_RAX, None)
+    def path_args(regs):
+        # [(dirfd, pathname, follow)] of a PATH_SYSCALLS syscall
+        return [
+            (c_int(getattr(regs, dirfd)).value
+             if dirfd is not None else AT_FDCWD,
+             getattr(regs, path), follow)
+            for dirfd, path, follow in PATH_SYSCALLS[regs.orig_rax]]
 
-    def get_syscall_result(pid):
-        return ptrace(PTRACE_PEEKUSER, pid, 8 * RAX, None)
+    def is_thread_clone(regs):
+        return (regs.orig_rax == SYS_clone and
+                bool(regs.rdi & CLONE_THREAD))
 
-    def allow_syscall(pid, num):
-        if num == SYS_open:
-            flags = ptrace(PTRACE_PEEKUSER, pid, 8 * RSI, None)
-        elif num == SYS_openat:
-            flags = ptrace(PTRACE_PEEKUSER, pid, 8 * RDX, None)
+    def allow_syscall(regs):
+        if regs.orig_rax == SYS_open:
+            flags = regs.rsi
+        elif regs.orig_rax == SYS_openat:
+            flags = regs.rdx
         else:
             return False
 
@@ -1,9 +1,35 @@
+import os
+
 from .runner import BinaryMixin
+from .utils import which
+
+
+class PCHMixin(BinaryMixin):
+    PCH_CACHE = None
+    PCH_HEADERS = ()
+
+    def compile(self, args):
+        if self.PCH_CACHE is not None:
+            PATH = os.environ["PATH"]
+            include = self.PCH_CACHE.include_dir(
+                which(self.COMPILER, PATH), self.PCH_LANGUAGE,
+                self.PCH_HEADERS, args,
+                {'TMPDIR': self._tempdir, 'PATH': PATH},
+                self._tempdir, self.execcon(self.COMPILE_LEVEL),
+                self.filecon(self.COMPILE_LEVEL))
+
+            if include is not None:
+                args = ['-I' + include] + args
+
+        return BinaryMixin.compile(self, args)
 
 
-class GCCMixin(BinaryMixin):
+class GCCMixin(PCHMixin):
     COMPILER = "gcc"
+    PCH_LANGUAGE = "c-header"
 
 
-class GXXMixin(BinaryMixin):
+class GXXMixin(PCHMixin):
     COMPILER = "g++"
+    PCH_LANGUAGE = "c++-header"
+    PCH_HEADERS = ("bits/stdc++.h",)
@@ -1,8 +1,10 @@
+from contextlib import closing
 from os import EX_OK
 from os.path import exists
 from shlex import split
 import sys
 
+from .summary import Benchmark, confidence_halfwidth, summarize
 from .verdict import AC, CE, SE, verdicttext
 
 
@@ -10,7 +12,8 @@ class Judge(object):
 
     def __init__(self, runners, langs,
                  time_grace_factor=5.0, rss_grace_factor=5, vm_grace_factor=5,
-                 time_limit=None, rss_limit=None, vm_limit=None):
+                 time_limit=None, rss_limit=None, vm_limit=None,
+                 output_limit=None, result_cache=None, scheduler=None):
         self._runners = runners
         self._langs = langs
 
@@ -21,6 +24,9 @@ class Judge(object):
         self._time_limit = time_limit
         self._rss_limit = rss_limit
         self._vm_limit = vm_limit
+        self._output_limit = output_limit
+        self._result_cache = result_cache
+        self._scheduler = scheduler
 
     def _parse_args(self, cmdline):
         args = self._langs.get(cmdline, split(cmdline))
@@ -30,12 +36,110 @@ class Judge(object):
         else:
             return (None, None)
 
-    def _run(self, cmdline, src_path, files, limits=None,
-             times=1, normalize=False, filename=None):
+    def max_rss(self, rss_limit):
+        rss_limit = rss_limit * self._rss_grace_factor
+
+        if self._rss_limit is not None:
+            rss_limit = min(rss_limit, self._rss_limit)
+
+        return rss_limit
+
+    def _adapt_limits(self, r, limits):
+        if limits is not None:
+            time_limit, rss_limit, vm_limit = limits
+            time_limit, rss_limit, vm_limit = r.adapt_limit(
+                time_limit * self._time_grace_factor,
+                rss_limit * self._rss_grace_factor,
+                vm_limit * self._vm_grace_factor)
+
+            if self._time_limit is not None:
+                time_limit = min(time_limit, self._time_limit)
+
+            if self._rss_limit is not None:
+                rss_limit = min(rss_limit, self._rss_limit)
+
+            if self._vm_limit is not None:
+                vm_limit = min(vm_limit, self._vm_limit)
+        else:
+            time_limit = self._time_limit
+            rss_limit = self._rss_limit
+            vm_limit = self._vm_limit
+
+        return time_limit, rss_limit, vm_limit
+
+    def _adapt_output_limit(self, output_limit):
+        if output_limit is None:
+            return self._output_limit
+
+        if self._output_limit is not None:
+            return min(output_limit, self._output_limit)
+
+        return output_limit
+
+    def _write_error(self, error_file, output):
+        if isinstance(error_file, str):
+            with open(error_file, 'wb') as f:
+                f.write(output)
+        else:
+            error_file.write(output)
+
+    def _run_cached(self, r, input_filename, output_filename, limits,
+                    output_limit, checker, stats):
+        cache = self._result_cache
+        checker_id = getattr(checker, 'cache_id', None)
+
+        # stats only come from a real run, and two checkers without a
+        # cache_id could not be told apart
+        if stats or (checker is not None and checker_id is None):
+            cache = None
+
+        if cache is not None:
+            key = cache.key(
+                "%s.%s" % (type(r).__module__, type(r).__name__),
+                r.binary_path, input_filename, output_filename,
+                limits, output_limit, checker_id, r.extra_files)
+            result = cache.get(key)
+
+            if result is not None:
+                return result
+
+        time_limit, rss_limit, vm_limit = limits
+        result = r.run(
+            stdin=r.open(input_filename, 'rb'),
+            stdout=r.open(output_filename, 'rb'),
+            time_limit=time_limit,
+            rss_limit=rss_limit,
+            vm_limit=vm_limit,
+            output_limit=output_limit,
+            checker=checker,
+            stats=stats)
+
+        if cache is not None:
+            cache.put(key, result, limits)
+
+        return result
+
+    def _judge_test(self, r, problem, testcase, limits, output_limit,
+                    checker, stats):
+        input_filename, output_filename = testcase
+        result = self._run_cached(
+            r, input_filename, output_filename, limits,
+            output_limit, checker, stats)
+
+        if self._scheduler is not None and problem is not None:
+            self._scheduler.record(
+                problem, input_filename, result[0] != AC, result[2])
+
+        return result
+
+    def _runs(self, cmdline, src_path, files, limits=None,
+              normalize=False, filename=None, checker=None,
+              output_limit=None, stats=False):
         Runner, args = self._parse_args(cmdline)
 
         if Runner is None:
-            return SE, -1, 0.0, 0, 0
+            yield SE, -1, 0.0, 0, 0
+            return
 
         input_filename = files[0]
         output_filename = files[1]
@@ -45,30 +149,14 @@ class Judge(object):
             result = r.compile(args)
 
             if result[0] != EX_OK:
-                return CE, -1, 0.0, 0, 0, result[1]
+                yield CE, -1, 0.0, 0, 0, result[1]
+                return
 
             for f in extra_files:
                 r.copy(f)
 
-            if limits is not None:
-                time_limit, rss_limit, vm_limit = limits
-                time_limit, rss_limit, vm_limit = r.adapt_limit(
-                    time_limit * self._time_grace_factor,
-                    rss_limit * self._rss_grace_factor,
-                    vm_limit * self._vm_grace_factor)
-
-                if self._time_limit is not None:
-                    time_limit = min(time_limit, self._time_limit)
-
-                if self._rss_limit is not None:
-                    rss_limit = min(rss_limit, self._rss_limit)
-
-                if self._vm_limit is not None:
-                    vm_limit = min(vm_limit, self._vm_limit)
-            else:
-                time_limit = self._time_limit
-                rss_limit = self._rss_limit
-                vm_limit = self._vm_limit
+            time_limit, rss_limit, vm_limit = self._adapt_limits(r, limits)
+            output_limit = self._adapt_output_limit(output_limit)
 
             if output_filename is not None:
                 # benchmark only
@@ -78,65 +166,235 @@ class Judge(object):
                         stdout=r.open(output_filename, 'wb'),
                         time_limit=time_limit,
                         rss_limit=rss_limit,
-                        vm_limit=vm_limit)
+                        vm_limit=vm_limit,
+                        output_limit=output_limit)
 
                     if bench_result[0] != AC:
-                        return bench_result
-
-            results = []
+                        yield bench_result
+                        return
 
-            for i in xrange(times):
-                result = r.run(
-                    stdin=r.open(input_filename, "rb"),
-                    stdout=r.open(output_filename, 'rb'),
-                    time_limit=time_limit,
-                    rss_limit=rss_limit,
-                    vm_limit=vm_limit)
+            while True:
+                if normalize:
+                    result = r.run(
+                        stdin=r.open(input_filename, "rb"),
+                        stdout=r.open(output_filename, 'rb'),
+                        time_limit=time_limit,
+                        rss_limit=rss_limit,
+                        vm_limit=vm_limit,
+                        output_limit=output_limit,
+                        checker=checker,
+                        stats=stats)
+                else:
+                    result = self._run_cached(
+                        r, input_filename, output_filename,
+                        (time_limit, rss_limit, vm_limit),
+                        output_limit, checker, stats)
 
                 if result[0] != AC:
-                    return result
+                    yield result
+                    return
 
                 if normalize:
-                    result = result[:2] + r.normalize_usage(*result[2:])
+                    result = (result[:2] +
+                              r.normalize_usage(*result[2:5]) +
+                              result[5:])
+
+                yield result
+
+    def _run(self, cmdline, src_path, files, limits=None,
+             times=1, normalize=False, filename=None, checker=None,
+             output_limit=None, stats=False):
+        results = []
+
+        with closing(self._runs(
+                cmdline, src_path, files, limits, normalize, filename,
+                checker, output_limit, stats)) as runs:
+            for result in runs:
+                if result[0] != AC:
+                    return result
 
                 results.append(result)
 
-            return results
+                if len(results) == times:
+                    return results
+
+    def _raise_failure(self, result):
+        if result[0] == CE:
+            print >>sys.stderr, result[5]
+            raise Exception("Compilation Error")
+
+        raise Exception(
+            "%s: exitcode %d, cputime: %f, rss: %d, vm: %d" % (
+                verdicttext[result[0]],
+                result[1], result[2], result[3], result[4]))
 
     def benchmark(self, cmdline, src_path, files,
-                  times=1, filename=None):
-        results = self._run(
-            cmdline, src_path, files,
-            times=times, normalize=True, filename=filename)
+                  times=1, filename=None, warmup=0, max_times=None,
+                  precision=None, percentiles=(50, 90, 99)):
+        if max_times is None:
+            max_times = times if precision is None else max(times, 50)
 
-        if not isinstance(results, list):
-            if results[0] == CE:
-                print >>sys.stderr, results[5]
-                raise Exception("Compilation Error")
+        samples = []
+
+        with closing(self._runs(
+                cmdline, src_path, files,
+                normalize=True, filename=filename)) as runs:
+            for i, result in enumerate(runs):
+                if result[0] != AC:
+                    self._raise_failure(result)
+
+                if i < warmup:
+                    continue
+
+                samples.append(result[2:5])
+
+                if len(samples) >= max_times:
+                    break
+
+                if len(samples) < times:
+                    continue
+
+                # stop once the 95% confidence interval of the mean
+                # cputime is within precision of the median
+                if precision is None:
+                    break
 
-            raise Exception(
-                "%s: exitcode %d, cputime: %f, rss: %d, vm: %d" % (
-                    verdicttext[results[0]],
-                    results[1], results[2], results[3], results[4]))
+                cputime = summarize([s[0] for s in samples], ())
+                if (confidence_halfwidth(cputime) <=
+                        precision * cputime.median):
+                    break
 
-        cputime, rss, vm = map(sum, zip(*(r[2:] for r in results)))
-        return cputime/times, rss/times, vm/times
+        cputime, rss, vm = [
+            summarize(s, percentiles) for s in zip(*samples)]
+        halfwidth = confidence_halfwidth(cputime)
+
+        return Benchmark(
+            cputime, rss, vm, warmup, halfwidth,
+            precision is None or halfwidth <= precision * cputime.median)
 
     def judge(self, cmdline, src_path, files, error_file,
-              time_limit, rss_limit, vm_limit, filename=None):
+              time_limit, rss_limit, vm_limit, filename=None, checker=None,
+              output_limit=None, stats=False):
         results = self._run(
             cmdline, src_path, files,
             (time_limit, rss_limit, vm_limit),
-            1, False, filename)
+            1, False, filename, checker, output_limit, stats)
 
         if not isinstance(results, list):
             if results[0] == CE:
-                if isinstance(error_file, str):
-                    with open(error_file, 'wb') as f:
-                        f.write(results[5])
-                else:
-                    error_file.write(results[5])
+                self._write_error(error_file, results[5])
                 return results[:-1]
             return results
 
         return results[0]
+
+    def prepare(self, cmdline, src_path, error_file, extra_files=(),
+                filename=None):
+        Runner, args = self._parse_args(cmdline)
+
+        if Runner is None:
+            return None, (SE, -1, 0.0, 0, 0)
+
+        r = Runner(src_path, filename)
+
+        try:
+            result = r.compile(args)
+
+            if result[0] != EX_OK:
+                self._write_error(error_file, result[1])
+                r.__exit__(None, None, None)
+                return None, (CE, -1, 0.0, 0, 0)
+
+            for f in extra_files:
+                r.copy(f)
+        except:
+            r.__exit__(*sys.exc_info())
+            raise
+
+        return r, None
+
+    def judge_prepared(self, r, files, time_limit, rss_limit, vm_limit,
+                       checker=None, output_limit=None, stats=False):
+        return self._run_cached(
+            r, files[0], files[1],
+            self._adapt_limits(r, (time_limit, rss_limit, vm_limit)),
+            self._adapt_output_limit(output_limit), checker, stats)
+
+    def interact(self, cmdline, src_path, interactor, error_file,
+                 time_limit, rss_limit, vm_limit, extra_files=(),
+                 filename=None, stats=False):
+        r, failure = self.prepare(
+            cmdline, src_path, error_file, extra_files, filename)
+
+        if failure is not None:
+            return failure
+
+        with r:
+            time_limit, rss_limit, vm_limit = self._adapt_limits(
+                r, (time_limit, rss_limit, vm_limit))
+
+            return r.interact(
+                interactor,
+                time_limit=time_limit,
+                rss_limit=rss_limit,
+                vm_limit=vm_limit,
+                stats=stats)
+
+    def judge_all(self, cmdline, src_path, testcases, error_file,
+                  time_limit, rss_limit, vm_limit,
+                  extra_files=(), stop_on_failure=True, filename=None,
+                  checker=None, output_limit=None, stats=False,
+                  problem=None):
+        r, failure = self.prepare(
+            cmdline, src_path, error_file, extra_files, filename)
+
+        if failure is not None:
+            yield None, failure
+            return
+
+        with r:
+            limits = self._adapt_limits(r, (time_limit, rss_limit, vm_limit))
+            output_limit = self._adapt_output_limit(output_limit)
+
+            order = range(len(testcases))
+            if (stop_on_failure and problem is not None and
+                    self._scheduler is not None):
+                order = self._scheduler.order(
+                    problem, [t[0] for t in testcases])
+
+            failure = None
+
+            for n, i in enumerate(order):
+                result = self._judge_test(
+                    r, problem, testcases[i], limits,
+                    output_limit, checker, stats)
+
+                if stop_on_failure and result[0] != AC:
+                    failure = n, i, result
+                    break
+
+                yield i, result
+
+            if failure is None:
+                return
+
+            # tests were run out of order, the failure reported is
+            # still the first one in canonical order
+            n, i, result = failure
+            ran = set(order[:n])
+
+            for j in range(i):
+                if j in ran:
+                    continue
+
+                earlier = self._judge_test(
+                    r, problem, testcases[j], limits,
+                    output_limit, checker, stats)
+
+                if earlier[0] != AC:
+                    i, result = j, earlier
+                    break
+
+                yield j, earlier
+
+            yield i, result
@@ -0,0 +1,153 @@
+from hashlib import sha256
+import os
+from os.path import dirname, exists, isfile, join, realpath
+from shutil import copyfile, rmtree
+from subprocess import Popen, PIPE, STDOUT
+from tempfile import mkdtemp
+
+from selinux import setexeccon, setfilecon, setfscreatecon
+
+from .cache import compiler_version
+
+
+class PCHCache(object):
+
+    def __init__(self, path, filecon=None):
+        self._path = path
+        self._filecon = filecon
+        self._ready = {}
+
+        if not exists(path):
+            os.makedirs(path)
+
+    def key(self, executable, language, headers, args):
+        h = sha256()
+
+        for part in [executable, compiler_version(executable),
+                     str(os.stat(executable).st_mtime), language] + \
+                list(headers) + list(args):
+            h.update("%d:" % len(part))
+            h.update(part)
+
+        return h.hexdigest()
+
+    def include_dir(self, executable, language, headers, args, env=None,
+                    builddir=None, execcon=None, buildcon=None):
+        if not headers:
+            return None
+
+        key = self.key(executable, language, headers, args)
+        include = self._ready.get(key)
+
+        if include is None:
+            include = join(self._path, key)
+
+            if not exists(include):
+                self._build(
+                    include, executable, language, headers, args, env,
+                    builddir, execcon, buildcon)
+
+            self._ready[key] = include
+
+        return include
+
+    def _build(self, include, executable, language, headers, args, env,
+               builddir, execcon, buildcon):
+        # the args may come from a submission, so the compiler runs like the
+        # compile itself, in builddir under execcon.  Only the headers it
+        # leaves there are copied into the cache.
+        setfscreatecon(buildcon)
+        builddir = mkdtemp(prefix='.pch.', dir=builddir or self._path)
+        setfscreatecon(None)
+        builddir = realpath(builddir)
+        staging = mkdtemp(prefix='.', dir=self._path)
+        tempdir = join(staging, 'include')
+
+        try:
+            for header in headers:
+                self._build_header(
+                    builddir, executable, language, header, args, env,
+                    execcon, buildcon)
+
+            os.mkdir(tempdir)
+
+            for header in headers:
+                self._take(builddir, tempdir, header + '.gch')
+
+            self._seal(tempdir)
+            os.rename(tempdir, include)
+        except:
+            # another judge may have won the rename
+            if not exists(include):
+                raise
+        finally:
+            self._remove(builddir)
+            self._remove(staging)
+
+    def _take(self, builddir, tempdir, name):
+        # a copy of builddir/name if the compiler left a regular file there,
+        # never following a link it may have made instead
+        source = join(builddir, name)
+
+        if realpath(source) != source or not isfile(source):
+            return
+
+        target = join(tempdir, name)
+        if not exists(dirname(target)):
+            os.makedirs(dirname(target))
+
+        copyfile(source, target)
+
+    def _build_header(self, tempdir, executable, language, header, args, env,
+                      execcon, buildcon):
+        # gcc picks up <dir>/<header>.gch from -I<dir> in place of the
+        # header, whatever the file it was compiled from
+        stub = join(tempdir, '.stub.h')
+        with open(stub, 'wb') as f:
+            f.write("#include <%s>\n" % header)
+
+        target = join(tempdir, header + '.gch')
+        if not exists(dirname(target)):
+            os.makedirs(dirname(target))
+
+        with open(os.devnull, 'rb') as stdin:
+            setfscreatecon(buildcon)
+            setexeccon(execcon)
+            p = Popen(
+                [executable] + list(args) +
+                ['-x', language, '-o', target, stub],
+                stdin=stdin, stdout=PIPE, stderr=STDOUT,
+                close_fds=True, cwd=tempdir, env=env)
+            setexeccon(None)
+            setfscreatecon(None)
+        p.communicate()
+
+        os.unlink(stub)
+
+        # a failed build leaves no .gch, the compile falls back to the header
+        if p.returncode != 0 and exists(target):
+            os.unlink(target)
+
+    def _seal(self, tempdir):
+        for root, dirs, files in os.walk(tempdir):
+            for name in files:
+                path = join(root, name)
+                os.chmod(path, 0o444)
+                if self._filecon is not None:
+                    setfilecon(path, self._filecon)
+
+            os.chmod(root, 0o555)
+            if self._filecon is not None:
+                setfilecon(root, self._filecon)
+
+    def _remove(self, path):
+        for root, dirs, files in os.walk(path):
+            os.chmod(root, 0o755)
+
+        rmtree(path, True)
+
+    def invalidate(self):
+        self._ready.clear()
+
+        for name in os.listdir(self._path):
+            self._remove(join(self._path, name))
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from os import readlink
+from os.path import dirname, join, normpath, realpath
+
+# as in the kernel, a path following more symlinks fails with ELOOP
+MAXSYMLINKS = 40
+
+
+def _split(path):
+    return [part for part in normpath(path).split('/') if part]
+
+
+def resolve(path, pid, tid, follow=True):
+    # realpath as the tracee sees it, /proc/self would be the tracer's own.
+    # None for a symlink loop.  Without follow a last component that is a
+    # symlink is kept, as unlink or rename would see it.
+    parent, name = path.rsplit('/', 1)
+
+    if not follow and name not in ('', '.', '..'):
+        parent = resolve(parent or '/', pid, tid)
+        return None if parent is None else join(parent, name)
+
+    resolved = '/'
+    todo = list(reversed(path.split('/')))
+    links = 0
+
+    while todo:
+        part = todo.pop()
+
+        if part in ('', '.'):
+            continue
+
+        if part == '..':
+            resolved = dirname(resolved)
+            continue
+
+        current = join(resolved, part)
+
+        if current == '/proc/self':
+            target = str(pid)
+        elif current == '/proc/thread-self':
+            target = "%d/task/%d" % (pid, tid)
+        else:
+            try:
+                target = readlink(current)
+            except OSError:
+                resolved = current
+                continue
+
+        links += 1
+        if links > MAXSYMLINKS:
+            return None
+
+        if target.startswith('/'):
+            resolved = '/'
+
+        todo.extend(reversed(target.split('/')))
+
+    return resolved
+
+
+class PrefixTrie(object):
+
+    def __init__(self, prefixes=()):
+        self._root = {}
+
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        node = self._root
+        for part in _split(prefix):
+            node = node.setdefault(part, {})
+
+        # None marks the end of a prefix
+        node[None] = True
+
+    def match(self, path):
+        node = self._root
+
+        if None in node:
+            return True
+
+        for part in _split(path):
+            node = node.get(part)
+
+            if node is None:
+                return False
+
+            if None in node:
+                return True
+
+        return False
+
+
+class PathPolicy(object):
+    CACHE_SIZE = 1024
+
+    def __init__(self, read=(), write=()):
+        self._read = PrefixTrie(read)
+        self._write = PrefixTrie(write)
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _decide(self, path, write):
+        if self._write.match(path):
+            return True
+
+        return not write and self._read.match(path)
+
+    def allow(self, path, write=False):
+        key = (path, write)
+
+        try:
+            decision = self._cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            decision = self._decide(path, write)
+            self.misses += 1
+
+            if len(self._cache) >= self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+        self._cache[key] = decision
+        return decision
+
+    def bind(self, sandbox):
+        return SandboxPolicy(self, sandbox)
+
+
+# a PathPolicy plus the sandbox directory of one run, which is always
+# readable and writable.  The decision cache stays with the shared policy.
+class SandboxPolicy(object):
+
+    def __init__(self, policy, sandbox):
+        self._policy = policy
+        self._sandbox = realpath(sandbox) + '/'
+
+    def allow(self, path, write=False):
+        path = normpath(path)
+
+        if path.startswith(self._sandbox):
+            return True
+
+        return self._policy.allow(path, write)
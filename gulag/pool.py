@@ -0,0 +1,223 @@
+from cPickle import dumps, HIGHEST_PROTOCOL
+from itertools import count
+from multiprocessing import Process, Queue as ProcessQueue
+from os import sysconf
+from Queue import Queue
+from signal import SIGCHLD
+from threading import Condition, Thread
+import traceback
+
+from .compat import block_signals, get_affinity, set_affinity
+from .verdict import QU, CJ
+
+
+def _worker(judge, cpu, tasks, done):
+    # a SIGCHLD delivered to the thread feeding a queue never reaches
+    # the signalfd, block it before the first put starts that thread
+    block_signals([SIGCHLD])
+    set_affinity(0, [cpu])
+
+    for job_id, args, kwargs in iter(tasks.get, None):
+        try:
+            result = judge.judge(*args, **kwargs)
+        except Exception:
+            traceback.print_exc()
+            result = (CJ, -1, 0.0, 0, 0)
+
+        done.put((job_id, result))
+
+
+def _compile_worker(judge, cpus, tasks, ready, done):
+    block_signals([SIGCHLD])
+    set_affinity(0, cpus)
+
+    for job_id, args, kwargs in iter(tasks.get, None):
+        (cmdline, src_path, files, error_file,
+         time_limit, rss_limit, vm_limit) = args
+
+        try:
+            r, failure = judge.prepare(
+                cmdline, src_path, error_file, files[2:],
+                kwargs['filename'])
+        except Exception:
+            traceback.print_exc()
+            r, failure = None, (CJ, -1, 0.0, 0, 0)
+
+        if failure is not None:
+            done.put((job_id, failure))
+            continue
+
+        # blocks while the run stage is behind
+        ready.put((
+            job_id, r,
+            (files[:2], time_limit, rss_limit, vm_limit),
+            {'checker': kwargs['checker'],
+             'output_limit': kwargs['output_limit']}))
+
+
+def _run_worker(judge, cpu, ready, done):
+    block_signals([SIGCHLD])
+    set_affinity(0, [cpu])
+
+    for job_id, r, args, kwargs in iter(ready.get, None):
+        try:
+            with r:
+                result = judge.judge_prepared(r, *args, **kwargs)
+        except Exception:
+            traceback.print_exc()
+            result = (CJ, -1, 0.0, 0, 0)
+
+        done.put((job_id, result))
+
+
+class JudgePool(object):
+
+    def __init__(self, judge, cpus=None, memory=None):
+        self._judge = judge
+        self._cpus = cpus or get_affinity(0)
+
+        if memory is None:
+            memory = sysconf('SC_PHYS_PAGES')
+
+        self._memory = memory
+        self._reserved = 0
+        self._reservations = {}
+        self._cond = Condition()
+        self._ids = count()
+
+        self._tasks = ProcessQueue()
+        self._done = ProcessQueue()
+        self._pending = Queue()
+        self.results = Queue()
+
+        self._workers = self._start_workers()
+
+        self._dispatcher = Thread(target=self._dispatch)
+        self._collector = Thread(target=self._collect)
+
+        for t in (self._dispatcher, self._collector):
+            t.daemon = True
+            t.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _start_workers(self):
+        workers = [
+            Process(
+                target=_worker,
+                args=(self._judge, cpu, self._tasks, self._done))
+            for cpu in self._cpus]
+
+        for p in workers:
+            p.daemon = True
+            p.start()
+
+        return workers
+
+    def _join_workers(self):
+        for p in self._workers:
+            p.join()
+
+    def _dispatch(self):
+        for job_id, args, kwargs, memory in iter(self._pending.get, None):
+            with self._cond:
+                while self._reserved + memory > self._memory:
+                    self._cond.wait()
+
+                self._reserved += memory
+                self._reservations[job_id] = memory
+
+            self._tasks.put((job_id, args, kwargs))
+
+        for p in self._workers:
+            self._tasks.put(None)
+
+    def _collect(self):
+        for job_id, result in iter(self._done.get, None):
+            with self._cond:
+                self._reserved -= self._reservations.pop(job_id)
+                self._cond.notify()
+
+            self.results.put((job_id, result))
+
+    def submit(self, cmdline, src_path, files, error_file,
+               time_limit, rss_limit, vm_limit, filename=None, checker=None,
+               output_limit=None):
+        # an open file pickles fine, but not into something writable
+        if not isinstance(error_file, basestring):
+            raise TypeError("error_file must be a path")
+
+        args = (cmdline, src_path, files, error_file,
+                time_limit, rss_limit, vm_limit)
+        kwargs = {'filename': filename, 'checker': checker,
+                  'output_limit': output_limit}
+
+        # the task queue pickles in a feeder thread, which would drop the
+        # job and leak its reservation, so fail here instead
+        dumps((args, kwargs), HIGHEST_PROTOCOL)
+
+        job_id = next(self._ids)
+
+        self.results.put((job_id, (QU, -1, 0.0, 0, 0)))
+        self._pending.put((
+            job_id, args, kwargs,
+            min(self._judge.max_rss(rss_limit), self._memory)))
+
+        return job_id
+
+    def close(self):
+        self._pending.put(None)
+        self._dispatcher.join()
+        self._join_workers()
+        self._done.put(None)
+        self._collector.join()
+
+
+class JudgePipeline(JudgePool):
+
+    def __init__(self, judge, compile_cpus=None, run_cpus=None,
+                 compile_workers=None, depth=None, memory=None):
+        cpus = get_affinity(0)
+
+        # by default one cpu compiles and the others only run
+        self._compile_cpus = compile_cpus or cpus[:1]
+        run_cpus = run_cpus or [
+            cpu for cpu in cpus if cpu not in self._compile_cpus] or cpus
+
+        self._compile_workers = compile_workers or len(self._compile_cpus)
+        self._ready = ProcessQueue(depth or len(run_cpus))
+
+        JudgePool.__init__(self, judge, run_cpus, memory)
+
+    def _start_workers(self):
+        compilers = [
+            Process(
+                target=_compile_worker,
+                args=(self._judge, self._compile_cpus,
+                      self._tasks, self._ready, self._done))
+            for i in range(self._compile_workers)]
+
+        self._runners = [
+            Process(
+                target=_run_worker,
+                args=(self._judge, cpu, self._ready, self._done))
+            for cpu in self._cpus]
+
+        for p in compilers + self._runners:
+            p.daemon = True
+            p.start()
+
+        return compilers
+
+    def _join_workers(self):
+        JudgePool._join_workers(self)
+
+        for p in self._runners:
+            self._ready.put(None)
+
+        for p in self._runners:
+            p.join()
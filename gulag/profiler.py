@@ -0,0 +1,164 @@
+from bisect import bisect_right
+from collections import Counter
+from os.path import basename, realpath
+from subprocess import Popen, PIPE
+
+from .compat import FrameReader, get_frame
+
+ET_EXEC = 2
+
+
+def read_maps(pid):
+    # sorted (start, end, offset, path) of the executable mappings
+    maps = []
+
+    with open("/proc/%d/maps" % pid, "r") as f:
+        for line in f:
+            fields = line.split(None, 5)
+
+            if len(fields) < 6 or 'x' not in fields[1]:
+                continue
+
+            start, end = [int(x, 16) for x in fields[0].split('-')]
+            maps.append((start, end, int(fields[2], 16), fields[5].strip()))
+
+    maps.sort()
+    return maps
+
+
+def read_symbols(binary):
+    # sorted (address, name) of the functions defined in binary
+    try:
+        p = Popen(
+            ['nm', '--defined-only', '-n', '-C', binary],
+            stdout=PIPE, stderr=PIPE, close_fds=True)
+    except OSError:
+        return []
+
+    symbols = []
+
+    for line in p.communicate()[0].splitlines():
+        fields = line.split(' ', 2)
+
+        if len(fields) == 3 and fields[1] in 'tTwW':
+            symbols.append((int(fields[0], 16), fields[2]))
+
+    return symbols
+
+
+def elf_type(binary):
+    with open(binary, 'rb') as f:
+        header = f.read(18)
+
+    if len(header) < 18 or header[:4] != '\x7fELF':
+        return None
+
+    return ord(header[16]) | (ord(header[17]) << 8)
+
+
+class Profiler(object):
+    INTERVAL = 0.01
+    MAX_SAMPLES = 10000
+    STACK_DEPTH = 64
+
+    def __init__(self, binary, interval=None, max_samples=None,
+                 stack_depth=None):
+        self.binary = realpath(binary)
+        self.interval = interval or self.INTERVAL
+        self.max_samples = max_samples or self.MAX_SAMPLES
+        self.stack_depth = (
+            self.STACK_DEPTH if stack_depth is None else stack_depth)
+        self.samples = Counter()
+        self.total = 0
+        self._maps = []
+        self._starts = []
+        self._frames = FrameReader()
+
+    @property
+    def full(self):
+        return self.total >= self.max_samples
+
+    def _mapping(self, pc):
+        i = bisect_right(self._starts, pc) - 1
+
+        if i >= 0 and pc < self._maps[i][1]:
+            return self._maps[i]
+
+        return None
+
+    def _update_maps(self, pid):
+        try:
+            self._maps = read_maps(pid)
+        except IOError:
+            return
+
+        self._starts = [m[0] for m in self._maps]
+
+    def sample(self, pid, tid, regs):
+        pc, sp, fp = get_frame(regs)
+
+        # libraries come and go, the maps are read again on a miss
+        if self._mapping(pc) is None:
+            self._update_maps(pid)
+
+        stack = (pc,)
+
+        if self.stack_depth and fp >= sp:
+            stack += tuple(self._frames.walk(tid, fp, self.stack_depth))
+
+        self.samples[stack] += 1
+        self.total += 1
+
+    def _load_base(self):
+        # a PIE binary is linked at 0 and loaded anywhere
+        if elf_type(self.binary) == ET_EXEC:
+            return 0
+
+        for start, end, offset, path in self._maps:
+            if path == self.binary:
+                return start - offset
+
+        return 0
+
+    def _symbolize(self, pc, symbols, addresses, base):
+        mapping = self._mapping(pc)
+
+        if mapping is None:
+            return None
+
+        if mapping[3] != self.binary:
+            return "[%s]" % basename(mapping[3] or "anon")
+
+        i = bisect_right(addresses, pc - base) - 1
+        if i < 0:
+            return "[%s]" % basename(self.binary)
+
+        return symbols[i][1]
+
+    def folded(self):
+        symbols = read_symbols(self.binary)
+        addresses = [s[0] for s in symbols]
+        base = self._load_base()
+        stacks = Counter()
+
+        for stack, count in self.samples.iteritems():
+            frames = []
+
+            # return addresses point past the call, step back into it
+            for i, pc in enumerate(stack):
+                name = self._symbolize(
+                    pc if i == 0 else pc - 1, symbols, addresses, base)
+
+                # a frame pointer that was really a register stops here
+                if name is None:
+                    if i == 0:
+                        frames.append("[unknown]")
+                    break
+
+                frames.append(name)
+
+            stacks[';'.join(reversed(frames))] += count
+
+        return ''.join(
+            "%s %d\n" % (stack, count)
+            for stack, count in sorted(stacks.iteritems()))
@@ -3,120 +3,535 @@ try:
 except ImportError:
     from StringIO import StringIO
 from ctypes import sizeof
-from errno import EINTR, ENOSYS
+from errno import EINTR, ESRCH
 from fcntl import fcntl, F_GETFL, F_SETFL
+from io import FileIO
+from math import ceil
+from mmap import mmap, ACCESS_READ
+import os
 from os import (
-    close, read, wait4, waitpid,
+    close, fdopen, fstat, read, sysconf, wait4,
     O_NONBLOCK, SEEK_END, WUNTRACED, WIFSTOPPED, WSTOPSIG, WNOHANG)
-from resource import setrlimit, RLIMIT_CPU, RLIMIT_NPROC, RLIMIT_RSS
+from stat import S_ISREG
+from struct import unpack
+from resource import (
+    RLIMIT_CPU, RLIMIT_FSIZE, RLIMIT_NPROC, RLIMIT_RSS)
 import select
-from signal import SIGCHLD, SIGTRAP
+from signal import SIGCHLD, SIGPROF, SIGSTOP, SIGTRAP, SIGXCPU, SIGXFSZ
 from subprocess import Popen
-
-from .verdict import AC, WA, RE, TL, ML, RF
+from time import time
+
+from .verdict import AC, PE, WA, RE, TL, ML, OL, RF
+from .accounting import PAGESIZE, default_accounting
+from .policy import resolve
+from .spawn import load, spawn
+from .stats import TraceStats, run_hooks
+from .utils import TailBuffer
 from .compat import (
     sigset_t, sigemptyset, sigaddset,
     SIG_BLOCK, SIG_SETMASK, sigprocmask,
-    signalfd, signalfd_siginfo,
-    traceme, trap_syscall, RESTRICTED_SYSCALLS, MMAP_SYSCALLS,
-    get_syscall_number, get_syscall_result, allow_syscall)
+    signalfd, signalfd_siginfo, F_SETPIPE_SZ,
+    timerfd_create, set_timer, CLOCK_MONOTONIC, TFD_NONBLOCK, TFD_CLOEXEC,
+    trap_syscall, cont, get_regs, skip_syscall, user_regs_struct,
+    get_event_msg, get_siginfo, siginfo_t, SI_USER, WALL,
+    PTRACE_O_TRACESYSGOOD, PTRACE_O_TRACESECCOMP, PTRACE_O_TRACEEXIT,
+    PTRACE_O_TRACECLONE, PTRACE_O_TRACEEXEC,
+    PTRACE_EVENT_SECCOMP, PTRACE_EVENT_EXIT,
+    PTRACE_EVENT_CLONE, PTRACE_EVENT_EXEC,
+    seccomp_filter, StringReader,
+    RESTRICTED_SYSCALLS, MMAP_SYSCALLS, CLONE_SYSCALLS, ENOSYS_SYSCALLS,
+    LINK_SYSCALLS, PATH_SYSCALLS,
+    AT_FDCWD, get_syscall_number, open_args, path_args, allow_syscall,
+    is_thread_clone)
+
+
+CLK_TCK = sysconf('SC_CLK_TCK')
+
+STOP_VERDICTS = {SIGXCPU: TL, SIGXFSZ: OL}
+
+# syscall stops, told apart from real SIGTRAPs by PTRACE_O_TRACESYSGOOD
+SYSCALL_TRAP = SIGTRAP | 0x80
 
 
 class PTracedProcess(Popen):
+    COMPARE_BLOCK_SIZE = 1 << 16
+    MAX_COMPARE_BLOCK_SIZE = 1 << 20
+    STDERR_LIMIT = 1 << 16
+    TIMER_INTERVAL = 0.05
+    WALL_GRACE = 1.0
+    PROFILE_SIGNAL = SIGPROF
 
     def __init__(self, args, executable=None,
                  stdin=None, stdout=None, stderr=None,
                  cwd=None, env={},
-                 time_limit=None, rss_limit=None, vm_limit=None):
+                 time_limit=None, rss_limit=None, vm_limit=None,
+                 seccomp=True, accounting=None, output_limit=None,
+                 fast_spawn=True, policy=None, threads=None, profile=None):
+        assert threads is None or seccomp, "threads need the seccomp filter"
+
         self._time_limit = time_limit
         self._rss_limit = rss_limit
         self._vm_limit = vm_limit
+        self._output_limit = output_limit
+        self._output_size = 0
+        self._ticks = 0
+        self._seccomp = seccomp
+        self._threads = threads
+        # tid -> whether to sample memory on the exit stop, for each thread
+        # stopped between syscall entry and exit
+        self._syscalls = {}
+        self._starting = set()
+        self._regs = user_regs_struct()
+        self._policy = policy
+        self._strings = StringReader() if policy is not None else None
+        self._profile = profile
+        self._siginfo = siginfo_t()
+
+        accounting = accounting or default_accounting()
+        self._trace_memory = accounting.TRACE_MEMORY
+
+        syscalls = list(RESTRICTED_SYSCALLS)
+
+        if self._trace_memory:
+            syscalls += MMAP_SYSCALLS
+
+        if policy is not None:
+            syscalls += LINK_SYSCALLS + list(PATH_SYSCALLS)
+
+        if threads is not None:
+            # RLIMIT_NPROC 0 would stop threads too, so forks are caught here
+            syscalls += CLONE_SYSCALLS
+            self._cpu_limit = time_limit and time_limit * threads
+        else:
+            self._cpu_limit = time_limit
+
+        self._filter = seccomp_filter(syscalls, ENOSYS_SYSCALLS)
+        self._accounting = accounting(rss_limit, vm_limit)
+        self.accounting = accounting.NAME
 
         self.cputime = None
         self.maxrss = 0
         self.maxvm = 0
         self.verdict = None
+        self.stats = TraceStats()
+        self.stats.accounting = self.accounting
+        self._mapping = None
+        self._presentation_error = False
 
-        Popen.__init__(
-            self, args, bufsize=-1, executable=executable,
-            stdin=stdin, stdout=stdout, stderr=stderr, close_fds=True,
-            preexec_fn=self._preexec_hook, cwd=cwd, env=env)
+        options = PTRACE_O_TRACESYSGOOD | PTRACE_O_TRACEEXEC
 
-        _, status = waitpid(self.pid, WUNTRACED)
+        if threads is not None:
+            options |= PTRACE_O_TRACECLONE
 
-        assert WIFSTOPPED(status), "cannot start subprocess"
+        if seccomp:
+            options |= PTRACE_O_TRACESECCOMP
 
-        if WSTOPSIG(status) != SIGTRAP:
-            self.kill()
-            self.wait()
-            assert False, "subprocess stopped unexpectedly"
+        if not self._trace_memory:
+            options |= PTRACE_O_TRACEEXIT
 
-    def _preexec_hook(self):
-        setrlimit(RLIMIT_NPROC, (0, 0))
+        lib = load() if fast_spawn else None
+        self._start = time()
 
-        if self._time_limit is not None:
-            setrlimit(
-                RLIMIT_CPU,
-                (self._time_limit, self._time_limit+0.1))
+        # the child comes back stopped at exec, with the options set
+        # before it installed the filter
+        try:
+            self._spawn_child(
+                lib, args, executable, stdin, stdout, stderr, cwd, env,
+                options)
+        except:
+            self._accounting.close()
+            raise
 
-        if self._rss_limit is not None:
-            setrlimit(
-                RLIMIT_RSS,
-                (self._rss_limit, self._rss_limit+10))
+        self._tids = set([self.pid])
+
+        # stopped inside execve, without seccomp its exit stop comes next
+        if not seccomp:
+            self._syscalls[self.pid] = False
+
+    def _rlimits(self):
+        rlimits = []
 
-        traceme()
+        if self._threads is None:
+            rlimits.append((RLIMIT_NPROC, 0, 0))
+
+        # only a backstop, TL is normally caught by _on_timer first
+        if self._cpu_limit is not None:
+            cpu_limit = int(ceil(self._cpu_limit))
+            rlimits.append((RLIMIT_CPU, cpu_limit, cpu_limit+1))
+
+        if self._rss_limit is not None:
+            rlimits.append(
+                (RLIMIT_RSS, self._rss_limit, self._rss_limit+10))
+
+        if self._output_limit is not None:
+            rlimits.append(
+                (RLIMIT_FSIZE, self._output_limit, self._output_limit))
+
+        return rlimits
+
+    def _spawn_child(self, lib, args, executable,
+                     stdin, stdout, stderr, cwd, env, options):
+        # mirrors Popen.__init__, with the child set up by _spawn.c
+        handles = self._get_handles(stdin, stdout, stderr)
+
+        # since 2.7.11 the handles come with a set of fds to close
+        if len(handles) == 2:
+            handles = handles[0]
+
+        p2cread, p2cwrite, c2pread, c2pwrite, errread, errwrite = handles
+
+        self.stdin = self.stdout = self.stderr = None
+        self.returncode = None
+        self.universal_newlines = False
+        self._child_created = False
+
+        try:
+            self.pid = spawn(
+                lib, executable or args[0], args,
+                os.environ if env is None else env, cwd,
+                [-1 if fd is None else fd
+                 for fd in (p2cread, c2pwrite, errwrite)],
+                self._rlimits(), self._accounting.procs,
+                self._filter if self._seccomp else None, options)
+            self._child_created = True
+        except:
+            for fd in (p2cwrite, c2pread, errread):
+                if fd is not None:
+                    close(fd)
+            raise
+        finally:
+            if p2cread is not None and p2cwrite is not None:
+                close(p2cread)
+            if c2pwrite is not None and c2pread is not None:
+                close(c2pwrite)
+            if errwrite is not None and errread is not None:
+                close(errwrite)
+
+        if p2cwrite is not None:
+            self.stdin = fdopen(p2cwrite, 'wb')
+        if c2pread is not None:
+            self.stdout = fdopen(c2pread, 'rb')
+        if errread is not None:
+            self.stderr = fdopen(errread, 'rb')
+
+    def _resume(self, tid):
+        if self._seccomp and tid not in self._syscalls:
+            cont(tid)
+        else:
+            trap_syscall(tid)
 
     def statm(self):
+        self.stats.statm_reads += 1
         with open("/proc/%d/statm" % self.pid, "r") as f:
             return f.read().split(" ")
 
+    def vmpeak(self):
+        with open("/proc/%d/status" % self.pid, "r") as f:
+            for line in f:
+                if line.startswith("VmPeak:"):
+                    return int(line.split()[1]) * 1024 // PAGESIZE
+        return 0
+
+    def _exited(self, status, usage):
+        self.stats.wall_time = time() - self._start
+        self._handle_exitstatus(status)
+        self.cputime, maxrss, oom = self._accounting.collect(usage)
+        self.maxrss = max(self.maxrss, maxrss)
+
+        if oom and self.verdict is None:
+            self.verdict = ML
+
     def _on_sigchld(self, fd):
+        # it may be for another child of ours, like an interactor, which is
+        # why nothing here waits without WNOHANG
         read(fd, sizeof(signalfd_siginfo))
+        return self._poll_status()
+
+    def _poll_status(self):
+        # every thread stays stopped until resumed and a stop after its
+        # resume raises SIGCHLD again.  Only a thread new to this pass may
+        # have stopped on a SIGCHLD already read, so pass again for those.
+        # wait4(-1) would also reap an interactor.
+        if self.returncode is not None:
+            return True
+
+        tids = ()
+
+        while not self._tids.issubset(tids):
+            tids = set(self._tids)
+
+            for tid in tids:
+                if self._wait_tid(tid):
+                    return True
 
-        pid, status, usage = wait4(self.pid, WUNTRACED)
-        assert pid != 0
+        return False
 
+    def _wait_tid(self, tid):
+        pid, status, usage = wait4(tid, WNOHANG | WUNTRACED | WALL)
+        return pid != 0 and self._on_status(tid, status, usage)
+
+    def _reap(self):
+        for tid in self._tids:
+            if tid != self.pid:
+                try:
+                    wait4(tid, WALL)
+                except OSError:
+                    pass
+
+        _, status, usage = wait4(self.pid, WALL)
+        self._exited(status, usage)
+
+    def _on_status(self, tid, status, usage):
+        start = time()
+
+        try:
+            return self._handle_status(tid, status, usage)
+        except OSError as e:
+            # killed while stopped, e.g. by another thread's exit_group,
+            # its exit comes with a later SIGCHLD and is reaped there
+            if e.errno != ESRCH:
+                raise
+        finally:
+            self.stats.tracer_time += time() - start
+
+    def _from_profiler(self, tid):
+        get_siginfo(tid, self._siginfo)
+        return (self._siginfo.si_code == SI_USER and
+                self._siginfo.si_pid == os.getpid())
+
+    def _handle_status(self, tid, status, usage):
         if not WIFSTOPPED(status):
-            self._handle_exitstatus(status)
-            self.cputime = usage.ru_utime + usage.ru_stime
+            if tid != self.pid:
+                self._tids.discard(tid)
+                self._syscalls.pop(tid, None)
+                return
+
+            self._exited(status, usage)
             return True
 
-        if WSTOPSIG(status) != SIGTRAP:
+        self.stats.stops += 1
+
+        sig = WSTOPSIG(status)
+
+        # a new thread starts with a SIGSTOP meant for the tracer
+        if sig == SIGSTOP and tid in self._starting:
+            self._starting.discard(tid)
+            self._resume(tid)
+            return
+
+        # sent by _on_profile_timer, resuming drops it.  The program's own
+        # is handled like any other signal, as it would be unprofiled.
+        if (sig == self.PROFILE_SIGNAL and self._profile is not None and
+                self._from_profiler(tid)):
+            get_regs(tid, self._regs)
+            self._profile.sample(self.pid, tid, self._regs)
+            self._resume(tid)
+            return
+
+        if sig != SIGTRAP and sig != SYSCALL_TRAP:
+            if self.verdict is None:
+                self.verdict = STOP_VERDICTS.get(sig, RE)
+            self.kill()
+            return True
+
+        event = status >> 16
+
+        if event == PTRACE_EVENT_EXIT:
+            self.maxvm = max(self.maxvm, self.vmpeak())
+
+            if self._vm_limit and self.maxvm > self._vm_limit:
+                if self.verdict is None:
+                    self.verdict = ML
+
+            killed = False
+        elif event == PTRACE_EVENT_SECCOMP:
+            killed = self._syscall_entry(tid)
+        elif event == PTRACE_EVENT_CLONE:
+            killed = self._cloned(get_event_msg(tid))
+        elif event == PTRACE_EVENT_EXEC:
+            if self.verdict is None:
+                self.verdict = RF
+            self.kill()
+            return True
+        elif sig == SYSCALL_TRAP and tid in self._syscalls:
+            killed = self._syscall_exit(tid)
+        elif sig == SYSCALL_TRAP and not self._seccomp:
+            killed = self._syscall_entry(tid)
+        else:
             if self.verdict is None:
                 self.verdict = RE
             self.kill()
             return True
 
-        num = get_syscall_number(self.pid)
+        if killed:
+            return True
+
+        self._resume(tid)
+
+    def _cloned(self, tid):
+        self._tids.add(tid)
+        self._starting.add(tid)
+        self.stats.threads = max(self.stats.threads, len(self._tids))
+
+        if len(self._tids) > self._threads:
+            if self.verdict is None:
+                self.verdict = RF
+            self.kill()
+            return True
+
+        # its SIGSTOP may have come before the clone event, with the same
+        # SIGCHLD
+        return self._wait_tid(tid)
+
+    def _syscall_entry(self, tid):
+        # one PTRACE_GETREGS per stop, into the same struct every time
+        get_regs(tid, self._regs)
+        num = get_syscall_number(self._regs)
+        self.stats.syscalls[num] += 1
 
         if num in RESTRICTED_SYSCALLS:
-            if not allow_syscall(self.pid, num):
-                if self.verdict is None:
-                    self.verdict = RF
-                self.kill()
-                return True
+            allowed = self._allow_syscall(tid)
+        elif self._threads is not None and num in CLONE_SYSCALLS:
+            allowed = is_thread_clone(self._regs)
+        elif self._policy is not None and num in LINK_SYSCALLS:
+            allowed = False
+        elif self._policy is not None and num in PATH_SYSCALLS:
+            allowed = all(
+                self._allow_path(tid, dirfd, addr, True, follow)
+                for dirfd, addr, follow in path_args(self._regs))
+        elif num in ENOSYS_SYSCALLS:
+            # only seen without seccomp, which would have failed it
+            skip_syscall(tid, self._regs)
+            allowed = True
+        else:
+            allowed = True
 
-        elif num in MMAP_SYSCALLS:
-            ret = get_syscall_result(self.pid)
+        if not allowed:
+            if self.verdict is None:
+                self.verdict = RF
+            self.kill()
+            return True
 
-            if ret != -ENOSYS:
-                statm = self.statm()
+        sample = self._trace_memory and num in MMAP_SYSCALLS
 
-                self.maxvm = max(self.maxvm, int(statm[0]))
-                self.maxrss = max(self.maxrss, int(statm[1]))
+        # with seccomp only the syscalls sampled on exit need the exit stop
+        if sample or not self._seccomp:
+            self._syscalls[tid] = sample
 
-                if self._vm_limit and self.maxvm > self._vm_limit:
-                    if self.verdict is None:
-                        self.verdict = ML
-                    self.kill()
-                    return True
+    def _allow_syscall(self, tid):
+        # with a policy, symlinks are resolved here and the tracee cannot
+        # make new ones.  Still racy: another thread may rewrite the path
+        # in memory, or rename a directory on it, after the check.
+        if self._policy is None:
+            return allow_syscall(self._regs)
+
+        args = open_args(self._regs)
+        if args is None:
+            return False
+
+        dirfd, addr, write = args
+        return self._allow_path(tid, dirfd, addr, write)
+
+    def _allow_path(self, tid, dirfd, addr, write, follow=True):
+        path = self._strings.read(tid, addr)
+
+        if path is None:
+            return False
 
-        trap_syscall(self.pid)
+        if not path.startswith('/'):
+            base = "cwd" if dirfd == AT_FDCWD else "fd/%d" % dirfd
+            path = "/proc/%d/%s/%s" % (tid, base, path)
+
+        path = resolve(path, self.pid, tid, follow)
+
+        if path is None:
+            return False
+
+        return self._policy.allow(path, write)
+
+    def _syscall_exit(self, tid):
+        if self._syscalls.pop(tid):
+            return self._check_memory()
+
+    def _check_memory(self):
+        statm = self.statm()
+
+        self.maxvm = max(self.maxvm, int(statm[0]))
+        self.maxrss = max(self.maxrss, int(statm[1]))
+
+        if self._vm_limit and self.maxvm > self._vm_limit:
+            if self.verdict is None:
+                self.verdict = ML
+            self.kill()
+            return True
+
+    def sample_cputime(self):
+        try:
+            with open("/proc/%d/stat" % self.pid, "r") as f:
+                stat = f.read()
+        except IOError:
+            return 0.0
+
+        # the comm field may contain spaces, skip past it
+        fields = stat[stat.rindex(')') + 2:].split(" ")
+        return float(int(fields[11]) + int(fields[12])) / CLK_TCK
+
+    def _on_timer(self, fd):
+        return self._tick(unpack("Q", read(fd, 8))[0])
+
+    def _tick(self, ticks):
+        self._ticks += ticks
+
+        if self.returncode is not None:
+            return True
+
+        wall_limit = self._time_limit + self.WALL_GRACE
+
+        if (self._ticks * self.TIMER_INTERVAL > wall_limit or
+                self.sample_cputime() > self._cpu_limit):
+            if self.verdict is None:
+                self.verdict = TL
+            self.kill()
+            return True
+
+    def _on_profile_timer(self, fd):
+        read(fd, 8)
+
+        if self.returncode is not None or self._profile.full:
+            return True
+
+        # PTRACE_INTERRUPT needs PTRACE_SEIZE, a signal gives the same stop
+        try:
+            os.kill(self.pid, self.PROFILE_SIGNAL)
+        except OSError:
+            return True
+
+    def _check_output(self, size):
+        self._output_size += size
+        self.stats.output_bytes = self._output_size
+
+        if self._output_limit is not None:
+            if self._output_size > self._output_limit:
+                if self.verdict is None:
+                    self.verdict = OL
+                self.kill()
+                return True
 
     def _read_pipe(self, fd, buf):
         data = read(fd, 4096)
         if not data:
             return True
+        self.stats.stderr_bytes += len(data)
+        buf.write(data)
+
+    def _read_stdout(self, fd, buf):
+        data = read(fd, 4096)
+        if not data:
+            return True
+
+        if self._check_output(len(data)):
+            return True
+
         buf.write(data)
 
     def _compare_stdout(self, fd, compare):
@@ -131,6 +546,9 @@ class PTracedProcess(Popen):
                     self.verdict = WA
             return True
 
+        if self._check_output(len(data)):
+            return True
+
         expected = compare.read(len(data))
         if data != expected:
             if self.verdict is None:
@@ -138,94 +556,129 @@ class PTracedProcess(Popen):
             self.kill()
             return True
 
-    def communicate(self, compare_stdout=None):
-        mask = sigset_t()
-        oldmask = sigset_t()
-        sigemptyset(mask)
-        sigemptyset(oldmask)
-        sigaddset(mask, SIGCHLD)
-        sigprocmask(SIG_BLOCK, mask, oldmask)
+    def _compare_mapped(self, fd, pipe, expected):
+        buf = self._compare_buf
+        n = pipe.readinto(buf)
+
+        if not n:
+            if self._compared != len(expected):
+                if self.verdict is None:
+                    self.verdict = WA
+            return True
+
+        if self._check_output(n):
+            return True
+
+        if buffer(expected, self._compared, n) != buffer(buf, 0, n):
+            if self.verdict is None:
+                self.verdict = WA
+            self.kill()
+            return True
+
+        self._compared += n
+
+        if n == len(buf) and n < self.MAX_COMPARE_BLOCK_SIZE:
+            self._compare_buf = bytearray(n * 2)
+
+    def _map_expected(self, fd, compare):
+        st = fstat(compare.fileno())
+
+        if not S_ISREG(st.st_mode):
+            return (self._compare_stdout, compare)
+
+        if st.st_size:
+            expected = self._mapping = mmap(
+                compare.fileno(), 0, access=ACCESS_READ)
+        else:
+            expected = ''
+
+        try:
+            fcntl(fd, F_SETPIPE_SZ, self.MAX_COMPARE_BLOCK_SIZE)
+        except IOError:
+            pass
+
+        self._compared = 0
+        self._compare_buf = bytearray(self.COMPARE_BLOCK_SIZE)
+        return (self._compare_mapped, FileIO(fd, 'r', closefd=False), expected)
+
+    def _check_tokens(self, fd, checker):
+        data = read(fd, self.COMPARE_BLOCK_SIZE)
+
+        if not data:
+            verdict = checker.finish()
 
-        sfd = signalfd(-1, mask, 0)
-        fcntl(sfd, F_SETFL, fcntl(sfd, F_GETFL) | O_NONBLOCK)
+            if verdict == WA:
+                if self.verdict is None:
+                    self.verdict = WA
+            elif verdict == PE:
+                self._presentation_error = True
+            return True
+
+        if self._check_output(len(data)):
+            return True
+
+        if not checker.feed(data):
+            if self.verdict is None:
+                self.verdict = WA
+            self.kill()
+            return True
 
+    def _pipe_callbacks(self, compare_stdout=None, checker=None):
         fd_callbacks = {}
-        fd_callbacks[sfd] = (self._on_sigchld,)
 
         if self.stdout is not None:
-            if compare_stdout:
+            if checker is not None:
                 stdout = None
                 fd_callbacks[self.stdout.fileno()] = (
-                    self._compare_stdout, compare_stdout)
+                    self._check_tokens, checker)
+            elif compare_stdout:
+                stdout = None
+                fd = self.stdout.fileno()
+                fd_callbacks[fd] = self._map_expected(fd, compare_stdout)
             else:
                 stdout = StringIO()
                 fd_callbacks[self.stdout.fileno()] = (
-                    self._read_pipe, stdout)
+                    self._read_stdout, stdout)
         else:
             stdout = None
 
         if self.stderr is not None:
-            stderr = StringIO()
+            stderr = TailBuffer(self.STDERR_LIMIT)
             fd_callbacks[self.stderr.fileno()] = (
                 self._read_pipe, stderr)
         else:
             stderr = None
 
-        registered = 0
-        poller = select.poll()
-
-        for fd in fd_callbacks:
-            poller.register(
-                fd, (select.POLLIN | select.POLLPRI | select.POLLHUP))
-            registered += 1
-
-        trap_syscall(self.pid)
-
-        if self._time_limit is None:
-            timeout = None
-        else:
-            timeout = self._time_limit + 1.0
-
-        while registered:
-            try:
-                ready = poller.poll(timeout * 1000)
-            except select.error as e:
-                if e.args[0] == EINTR:
-                    continue
-
-                self.kill()
-                raise
-
-            if not ready:
-                if self.verdict is None:
-                    self.verdict = TL
-                self.kill()
-                continue
-
-            for fd, _mode in ready:
-                callback = fd_callbacks.get(fd, None)
+        return fd_callbacks, stdout, stderr
 
-                if callback is not None:
-                    unregister = callback[0](fd, *callback[1:])
+    def _finish(self, stdout, stderr):
+        if self.returncode is None:
+            self._reap()
 
-                    if unregister:
-                        poller.unregister(fd)
-                        registered -= 1
+        self._accounting.close()
 
         if self.verdict is None:
             self.verdict = AC if self.returncode == 0 else RE
 
             if self._time_limit is not None:
-                if self.cputime > self._time_limit:
+                if self.cputime > self._cpu_limit:
                     self.verdict = TL
 
+                # with threads the time limit is on the wall clock
+                if self._threads is not None:
+                    if self.stats.wall_time > self._time_limit:
+                        self.verdict = TL
+
             if self.verdict == RE:
                 if self._rss_limit is not None:
                     if self.maxrss > self._rss_limit:
                         self.verdict = ML
 
-        close(sfd)
-        sigprocmask(SIG_SETMASK, oldmask, None)
+            if self.verdict == AC and self._presentation_error:
+                self.verdict = PE
+
+        if self._mapping is not None:
+            self._mapping.close()
 
         if self.stdout is not None:
             self.stdout.close()
@@ -239,4 +692,77 @@ class PTracedProcess(Popen):
         if stderr is not None:
             stderr = stderr.getvalue()
 
+        run_hooks(self.stats)
         return (stdout, stderr)
+
+    def communicate(self, compare_stdout=None, checker=None):
+        mask = sigset_t()
+        oldmask = sigset_t()
+        sigemptyset(mask)
+        sigemptyset(oldmask)
+        sigaddset(mask, SIGCHLD)
+        sigprocmask(SIG_BLOCK, mask, oldmask)
+        sfd = tfd = pfd = None
+
+        try:
+            sfd = signalfd(-1, mask, 0)
+            fcntl(sfd, F_SETFL, fcntl(sfd, F_GETFL) | O_NONBLOCK)
+
+            fd_callbacks, stdout, stderr = self._pipe_callbacks(
+                compare_stdout, checker)
+            fd_callbacks[sfd] = (self._on_sigchld,)
+
+            registered = 0
+            poller = select.poll()
+
+            for fd in fd_callbacks:
+                poller.register(
+                    fd, (select.POLLIN | select.POLLPRI | select.POLLHUP))
+                registered += 1
+
+            # the timers only watch the tracee, the loop does not wait on them
+            if self._time_limit is not None:
+                tfd = timerfd_create(
+                    CLOCK_MONOTONIC, TFD_NONBLOCK | TFD_CLOEXEC)
+                set_timer(tfd, self.TIMER_INTERVAL)
+                fd_callbacks[tfd] = (self._on_timer,)
+                poller.register(tfd, select.POLLIN)
+
+            if self._profile is not None:
+                pfd = timerfd_create(
+                    CLOCK_MONOTONIC, TFD_NONBLOCK | TFD_CLOEXEC)
+                set_timer(pfd, self._profile.interval)
+                fd_callbacks[pfd] = (self._on_profile_timer,)
+                poller.register(pfd, select.POLLIN)
+
+            self._resume(self.pid)
+
+            while registered:
+                try:
+                    ready = poller.poll()
+                except select.error as e:
+                    if e.args[0] == EINTR:
+                        continue
+
+                    self.kill()
+                    raise
+
+                for fd, _mode in ready:
+                    callback = fd_callbacks.get(fd, None)
+
+                    if callback is not None:
+                        unregister = callback[0](fd, *callback[1:])
+
+                        if unregister:
+                            poller.unregister(fd)
+                            if fd != tfd and fd != pfd:
+                                registered -= 1
+        finally:
+            # whatever went wrong, SIGCHLD must not stay blocked
+            for fd in (sfd, tfd, pfd):
+                if fd is not None:
+                    close(fd)
+
+            sigprocmask(SIG_SETMASK, oldmask, None)
+
+        return self._finish(stdout, stderr)
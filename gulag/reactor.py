@@ -0,0 +1,202 @@
+from ctypes import sizeof
+from errno import EAGAIN, EINTR
+from fcntl import fcntl, F_GETFL, F_SETFL
+from os import close, read, O_NONBLOCK
+import select
+from signal import SIGCHLD
+from struct import unpack
+
+from .compat import (
+    sigset_t, sigemptyset, sigaddset,
+    SIG_BLOCK, SIG_SETMASK, sigprocmask,
+    signalfd, signalfd_siginfo,
+    timerfd_create, set_timer, CLOCK_MONOTONIC, TFD_NONBLOCK, TFD_CLOEXEC)
+from .ptrace import PTracedProcess
+
+
+EVENTS = select.EPOLLIN | select.EPOLLPRI | select.EPOLLHUP
+
+
+class _Run(object):
+
+    def __init__(self, process, fds, stdout, stderr):
+        self.process = process
+        self.fds = fds
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exited = False
+
+
+# drives many PTracedProcess from one thread.  SIGCHLD stays blocked in
+# that thread while the reactor is open, and only pids added to it are
+# waited for, so other children of the judge are left alone.
+class Reactor(object):
+
+    TIMER_INTERVAL = PTracedProcess.TIMER_INTERVAL
+
+    def __init__(self):
+        self._mask = sigset_t()
+        self._oldmask = sigset_t()
+        sigemptyset(self._mask)
+        sigemptyset(self._oldmask)
+        sigaddset(self._mask, SIGCHLD)
+        sigprocmask(SIG_BLOCK, self._mask, self._oldmask)
+
+        self._sfd = signalfd(-1, self._mask, 0)
+        fcntl(self._sfd, F_SETFL, fcntl(self._sfd, F_GETFL) | O_NONBLOCK)
+
+        self._tfd = timerfd_create(
+            CLOCK_MONOTONIC, TFD_NONBLOCK | TFD_CLOEXEC)
+        set_timer(self._tfd, self.TIMER_INTERVAL)
+
+        self._epoll = select.epoll()
+        self._epoll.register(self._sfd, select.EPOLLIN)
+        self._epoll.register(self._tfd, select.EPOLLIN)
+
+        self._runs = {}
+        self._fds = {}
+        self._timed = set()
+        self._finished = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._runs)
+
+    def add(self, process, compare_stdout=None, checker=None):
+        fd_callbacks, stdout, stderr = process._pipe_callbacks(
+            compare_stdout, checker)
+        run = _Run(process, set(fd_callbacks), stdout, stderr)
+
+        for fd, callback in fd_callbacks.items():
+            self._fds[fd] = (run, callback)
+            self._epoll.register(fd, EVENTS)
+
+        self._runs[process.pid] = run
+
+        if process._time_limit is not None:
+            # the expirations so far belong to the runs already here
+            self._on_timer()
+            self._timed.add(run)
+
+        process._resume(process.pid)
+
+    def _unregister(self, run, fd):
+        self._epoll.unregister(fd)
+        del self._fds[fd]
+        run.fds.discard(fd)
+        self._check_finished(run)
+
+    def _check_finished(self, run):
+        if run.exited and not run.fds:
+            del self._runs[run.process.pid]
+            self._timed.discard(run)
+            self._finished.append(run)
+
+    def _wait(self, pid):
+        run = self._runs.get(pid)
+
+        if run is None or run.exited:
+            return
+
+        run.process._poll_status()
+
+        if run.process.returncode is not None:
+            run.exited = True
+            self._timed.discard(run)
+            self._check_finished(run)
+
+    def _on_sigchld(self):
+        pids = []
+
+        while True:
+            try:
+                data = read(self._sfd, sizeof(signalfd_siginfo))
+            except OSError as e:
+                if e.errno == EAGAIN:
+                    break
+                raise
+
+            pids.append(signalfd_siginfo.from_buffer_copy(data).ssi_pid)
+
+        # SIGCHLD does not queue, and a thread reports its own tid, so
+        # sweep the others after the ones named
+        for pid in pids:
+            self._wait(pid)
+
+        for pid in self._runs.keys():
+            self._wait(pid)
+
+    def _on_timer(self):
+        try:
+            ticks = unpack("Q", read(self._tfd, 8))[0]
+        except OSError as e:
+            if e.errno == EAGAIN:
+                return
+            raise
+
+        for run in list(self._timed):
+            if run.process._tick(ticks):
+                self._timed.discard(run)
+
+    def _poll(self, timeout):
+        try:
+            return self._epoll.poll(timeout)
+        except IOError as e:
+            if e.errno == EINTR:
+                return []
+
+            for run in self._runs.values():
+                run.process.kill()
+            raise
+
+    def run(self, timeout=-1):
+        while self._runs or self._finished:
+            while self._finished:
+                run = self._finished.pop(0)
+                yield run.process, run.process._finish(run.stdout, run.stderr)
+
+            if not self._runs:
+                break
+
+            ready = self._poll(timeout)
+
+            if not ready and timeout >= 0:
+                return
+
+            for fd, _mode in ready:
+                if fd == self._sfd:
+                    self._on_sigchld()
+                elif fd == self._tfd:
+                    self._on_timer()
+                elif fd in self._fds:
+                    run, callback = self._fds[fd]
+
+                    if callback[0](fd, *callback[1:]):
+                        self._unregister(run, fd)
+
+    def close(self):
+        for run in self._runs.values():
+            run.process.kill()
+
+        for run in self._runs.values():
+            for fd in run.fds:
+                self._epoll.unregister(fd)
+            run.process._finish(run.stdout, run.stderr)
+
+        for run in self._finished:
+            run.process._finish(run.stdout, run.stderr)
+
+        self._runs.clear()
+        del self._finished[:]
+        self._fds.clear()
+        self._timed.clear()
+
+        self._epoll.close()
+        close(self._tfd)
+        close(self._sfd)
+        sigprocmask(SIG_SETMASK, self._oldmask, None)
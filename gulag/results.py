@@ -0,0 +1,180 @@
+from hashlib import sha256
+import json
+import os
+from os.path import basename, dirname, exists, getsize, join
+from shutil import rmtree
+from tempfile import mkstemp
+
+from . import __version__
+from .verdict import AC, PE, WA, RE, RF
+
+
+# verdicts that do not depend on how busy the machine was
+DETERMINISTIC_VERDICTS = (AC, PE, WA, RE, RF)
+
+
+def _source_digest():
+    # any change to gulag itself may change verdicts
+    h = sha256(__version__)
+    package = dirname(__file__)
+
+    for name in sorted(os.listdir(package)):
+        if name.endswith('.py') or name.endswith('.c'):
+            with open(join(package, name), 'rb') as f:
+                h.update(f.read())
+
+    return h.hexdigest()
+
+
+class ResultCache(object):
+    LOW_WATER = 0.9
+
+    def __init__(self, path, max_size=256 << 20, margin=0.8):
+        self._path = path
+        self._max_size = max_size
+        self._margin = margin
+        self._version = _source_digest()
+        self._digests = {}
+        self._size = None
+
+        if not exists(path):
+            os.makedirs(path)
+
+    def file_digest(self, filename):
+        st = os.stat(filename)
+        stamp = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        digest = self._digests.get(filename)
+
+        if digest is None or digest[0] != stamp:
+            h = sha256()
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 16), ''):
+                    h.update(block)
+            digest = (stamp, h.hexdigest())
+            self._digests[filename] = digest
+
+        return digest[1]
+
+    def key(self, runner, binary, input_filename, output_filename,
+            limits, output_limit, checker_id=None, extra_files=()):
+        h = sha256()
+        parts = [self._version, runner, self.file_digest(binary),
+                 self.file_digest(input_filename),
+                 self.file_digest(output_filename),
+                 repr(tuple(limits)), repr(output_limit), repr(checker_id)]
+
+        # the program may open them by name
+        for filename in extra_files:
+            parts += [basename(filename), self.file_digest(filename)]
+
+        for part in parts:
+            h.update("%d:" % len(part))
+            h.update(part)
+
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return join(self._path, key[:2], key)
+
+    def cacheable(self, result, limits):
+        if result[0] not in DETERMINISTIC_VERDICTS:
+            return False
+
+        # a run close to any limit could go either way next time
+        for usage, limit in zip(result[2:5], limits):
+            if limit is not None and usage > limit * self._margin:
+                return False
+
+        return True
+
+    def get(self, key):
+        entry = self._entry(key)
+
+        try:
+            with open(entry, 'rb') as f:
+                result = json.load(f)
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        return tuple(result[:5])
+
+    def put(self, key, result, limits):
+        if not self.cacheable(result, limits):
+            return
+
+        parent = join(self._path, key[:2])
+
+        if not exists(parent):
+            try:
+                os.mkdir(parent)
+            except OSError:
+                pass
+
+        fd, tmp = mkstemp(prefix='.', dir=parent)
+
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(list(result[:5]), f)
+
+        size = getsize(tmp)
+        os.rename(tmp, self._entry(key))
+
+        # only walk the whole cache once it may have grown too big
+        if self._size is None or self._size + size > self._max_size:
+            self.evict()
+        else:
+            self._size += size
+
+    def discard(self, key):
+        try:
+            os.unlink(self._entry(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = []
+        total = 0
+
+        for prefix in os.listdir(self._path):
+            parent = join(self._path, prefix)
+
+            for name in os.listdir(parent):
+                if name.startswith('.'):
+                    continue
+
+                entry = join(parent, name)
+
+                try:
+                    size = getsize(entry)
+                    mtime = os.stat(entry).st_mtime
+                except OSError:
+                    continue
+
+                entries.append((mtime, size, entry))
+                total += size
+
+        if total <= self._max_size:
+            self._size = total
+            return
+
+        entries.sort()
+
+        # evict a bit more than needed so puts don't walk the cache each time
+        for mtime, size, entry in entries:
+            if total <= self._max_size * self.LOW_WATER:
+                break
+
+            try:
+                os.unlink(entry)
+            except OSError:
+                pass
+            total -= size
+
+        self._size = total
+
+    def invalidate(self):
+        self._digests.clear()
+        self._size = None
+
+        for prefix in os.listdir(self._path):
+            rmtree(join(self._path, prefix), True)
@@ -2,24 +2,47 @@ __all__ = (
     "Runner", "BinaryMixin", "BytecodeMixin", "ScriptMixin")
 
 from contextlib import nested
+from ctypes import sizeof
+from errno import EINTR
 import os
 from os import EX_OK
 from os.path import basename, join, splitext
+import select
 from shutil import copy, rmtree
+from signal import SIGCHLD
 from subprocess import Popen, STDOUT, PIPE
 from tempfile import mkdtemp
+from time import time
 
 from selinux import (
     getcon, is_selinux_enabled, setexeccon,
     setfilecon, setfscreatecon, fgetfilecon, fsetfilecon)
 
+from .compat import (
+    sigset_t, sigemptyset, sigaddset, SIG_BLOCK, SIG_SETMASK, sigprocmask,
+    signalfd, signalfd_siginfo)
 from .ptrace import PTracedProcess
+from .sandbox import stage
 from .utils import which
+from .verdict import AC, PE, WA, TL, ML, OL, RF, CJ
 
 assert is_selinux_enabled(), "SELinux is currently disabled"
 
 
+_categories = {}
+
+
 def parse_category(s):
+    # the same few contexts come up on every run
+    result = _categories.get(s)
+
+    if result is None:
+        result = _categories[s] = frozenset(_parse_category(s))
+
+    return result
+
+
+def _parse_category(s):
     l = s.split(":")[5:]
     if not l:
         return set()
@@ -37,6 +60,13 @@ def parse_category(s):
     return result
 
 
+# testlib exit codes
+INTERACTOR_VERDICTS = {0: AC, 1: WA, 2: PE}
+
+# the interactor cannot hide these behind its own verdict
+CONTESTANT_VERDICTS = (TL, ML, OL, RF)
+
+
 def check_category(have, need):
     return bool(parse_category(need) - parse_category(have))
 
@@ -45,6 +75,14 @@ class Runner(object):
     SETYPE = 'sandbox_t'
     FILE_SETYPE = 'sandbox_file_t'
     TEMPDIR_PREFIX = "." + __package__
+    SECCOMP = True
+    FAST_SPAWN = True
+    ACCOUNTING = None
+    SANDBOX_POOL = None
+    PATH_POLICY = None
+    TEST_DATA = None
+    THREADS = None
+    INTERACTOR_GRACE = 1.0
 
     def adapt_limit(self, time_limit, rss_limit, vm_limit):
         return time_limit, rss_limit, vm_limit
@@ -55,11 +93,16 @@ class Runner(object):
     def __init__(self, src_path, filename=None):
         self._src_path = src_path
         self._filename = filename or basename(src_path)
+        self._extra_files = []
         self._con = getcon()[1].split(":")
 
-        setfscreatecon(self.filecon(self.COMPILE_LEVEL))
-        self._tempdir = mkdtemp(prefix=self.TEMPDIR_PREFIX)
-        setfscreatecon(None)
+        if self.SANDBOX_POOL is not None:
+            self._tempdir = self.SANDBOX_POOL.acquire(
+                self.filecon(self.COMPILE_LEVEL))
+        else:
+            setfscreatecon(self.filecon(self.COMPILE_LEVEL))
+            self._tempdir = mkdtemp(prefix=self.TEMPDIR_PREFIX)
+            setfscreatecon(None)
 
     def execcon(self, level):
         return "%s:%s:%s:%s" % (
@@ -75,12 +118,23 @@ class Runner(object):
         setfscreatecon(None)
 
     def copy(self, src):
-        setfscreatecon(self.filecon(self.RUN_LEVEL))
-        copy(src, join(self._tempdir, basename(src)))
-        setfscreatecon(None)
+        stage(
+            src, join(self._tempdir, basename(src)),
+            self.filecon(self.RUN_LEVEL))
+        self._extra_files.append(src)
+
+    @property
+    def extra_files(self):
+        return tuple(self._extra_files)
 
     def open(self, filename, mode):
         filecon = self.filecon(self.RUN_LEVEL)
+
+        if self.TEST_DATA is not None and mode in ('r', 'rb'):
+            f = self.TEST_DATA.open(filename, filecon)
+            if f is not None:
+                return f
+
         setfscreatecon(filecon)
         f = open(filename, mode)
         setfscreatecon(None)
@@ -95,14 +149,27 @@ class Runner(object):
     def run_env(self):
         return {}
 
+    @property
+    def binary_path(self):
+        return join(self._tempdir, self._filename)
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        rmtree(self._tempdir)
+        if self.SANDBOX_POOL is not None:
+            self.SANDBOX_POOL.release(
+                self._tempdir, self.filecon(self.COMPILE_LEVEL))
+        else:
+            rmtree(self._tempdir)
 
     def _spawn(self, stdin, stdout, stderr,
-               time_limit=None, rss_limit=None, vm_limit=None):
+               time_limit=None, rss_limit=None, vm_limit=None,
+               output_limit=None, profile=None):
+        policy = self.PATH_POLICY
+        if policy is not None:
+            policy = policy.bind(self._tempdir)
+
         setexeccon(self.execcon(self.RUN_LEVEL))
 
         p = PTracedProcess(
@@ -115,7 +182,14 @@ class Runner(object):
             env=self.run_env,
             time_limit=time_limit,
             rss_limit=rss_limit,
-            vm_limit=vm_limit)
+            vm_limit=vm_limit,
+            output_limit=output_limit,
+            seccomp=self.SECCOMP,
+            fast_spawn=self.FAST_SPAWN,
+            accounting=self.ACCOUNTING,
+            policy=policy,
+            threads=self.THREADS,
+            profile=profile)
 
         setexeccon(None)
         return p
@@ -124,7 +198,8 @@ class Runner(object):
         raise NotImplementedError
 
     def run(self, stdin, stdout,
-            time_limit=None, rss_limit=None, vm_limit=None):
+            time_limit=None, rss_limit=None, vm_limit=None,
+            output_limit=None, checker=None, stats=False, profile=None):
         stderr = open("/dev/null", "w")
         files = [stdin, stderr]
         compare = None
@@ -138,26 +213,152 @@ class Runner(object):
         with nested(*files):
             p = self._spawn(
                 stdin=stdin, stdout=stdout, stderr=stderr,
-                time_limit=time_limit, rss_limit=rss_limit, vm_limit=vm_limit)
+                time_limit=time_limit, rss_limit=rss_limit, vm_limit=vm_limit,
+                output_limit=output_limit, profile=profile)
+
+        if compare is not None and checker is not None:
+            p.communicate(checker=checker(compare))
+        else:
+            p.communicate(compare_stdout=compare)
+        result = (p.verdict, p.returncode,
+                  p.cputime, p.maxrss, p.maxvm)
+
+        if stats:
+            return result + (p.stats,)
+        return result
+
+    def _wait_interactor(self, p):
+        # SIGCHLD is blocked before the first poll(), an exit in between
+        # is still waiting in the signalfd
+        mask = sigset_t()
+        oldmask = sigset_t()
+        sigemptyset(mask)
+        sigemptyset(oldmask)
+        sigaddset(mask, SIGCHLD)
+        sigprocmask(SIG_BLOCK, mask, oldmask)
+        sfd = None
+
+        try:
+            sfd = signalfd(-1, mask, 0)
+            poller = select.poll()
+            poller.register(sfd, select.POLLIN)
+            deadline = time() + self.INTERACTOR_GRACE
+
+            while p.poll() is None:
+                timeout = deadline - time()
+
+                if timeout <= 0:
+                    p.kill()
+                    p.wait()
+                    return None
+
+                try:
+                    if poller.poll(timeout * 1000):
+                        os.read(sfd, sizeof(signalfd_siginfo))
+                except select.error as e:
+                    if e.args[0] != EINTR:
+                        raise
+        finally:
+            if sfd is not None:
+                os.close(sfd)
+
+            sigprocmask(SIG_SETMASK, oldmask, None)
+
+        return p.returncode
+
+    def interact(self, interactor, time_limit=None, rss_limit=None,
+                 vm_limit=None, stats=False):
+        # the two programs talk over plain pipes, the tracer never sees
+        # the bytes and seccomp lets read/write through without a stop
+        to_interactor = os.pipe()
+        to_contestant = os.pipe()
+
+        try:
+            with open("/dev/null", "w") as stderr:
+                p = self._spawn(
+                    stdin=to_contestant[0], stdout=to_interactor[1],
+                    stderr=stderr, time_limit=time_limit,
+                    rss_limit=rss_limit, vm_limit=vm_limit)
+
+            try:
+                i = Popen(
+                    interactor, stdin=to_interactor[0],
+                    stdout=to_contestant[1], close_fds=True)
+            except:
+                p.kill()
+                p.communicate()
+                raise
+        finally:
+            for fd in to_interactor + to_contestant:
+                os.close(fd)
+
+        p.communicate()
+        code = self._wait_interactor(i)
+
+        if p.verdict in CONTESTANT_VERDICTS:
+            verdict = p.verdict
+        else:
+            verdict = INTERACTOR_VERDICTS.get(code, CJ)
+            if verdict == AC:
+                verdict = p.verdict
+
+        result = (verdict, p.returncode,
+                  p.cputime, p.maxrss, p.maxvm)
 
-        p.communicate(compare_stdout=compare)
-        return p.verdict, p.returncode, p.cputime, p.maxrss, p.maxvm
+        if stats:
+            return result + (p.stats,)
+        return result
 
-    def debug(self, stdin, time_limit=None, rss_limit=None, vm_limit=None):
+    def debug(self, stdin, time_limit=None, rss_limit=None, vm_limit=None,
+              output_limit=None, stats=False, profile=None):
         with stdin:
             p = self._spawn(
                 stdin=stdin, stdout=PIPE, stderr=PIPE,
-                time_limit=time_limit, rss_limit=rss_limit, vm_limit=vm_limit)
+                time_limit=time_limit, rss_limit=rss_limit, vm_limit=vm_limit,
+                output_limit=output_limit, profile=profile)
 
         stdout, stderr = p.communicate()
-        return (p.verdict, p.returncode,
-                p.cputime, p.maxrss, p.maxvm,
-                stdout, stderr)
+        result = (p.verdict, p.returncode,
+                  p.cputime, p.maxrss, p.maxvm,
+                  stdout, stderr)
+
+        if stats:
+            return result + (p.stats,)
+        return result
 
 
 class CompilerMixin(object):
+    COMPILE_CACHE = None
+
+    @property
+    def binary_path(self):
+        return join(self._tempdir, self.target_filename)
+
+    def _restore(self, cached):
+        code, output, target = cached
+        setfilecon(self._tempdir, self.filecon(self.RUN_LEVEL))
+
+        if code != EX_OK:
+            return (code, output)
+
+        stage(
+            target, join(self._tempdir, self.target_filename),
+            self.filecon(self.RUN_LEVEL))
+
+        return (code,)
 
     def _compile(self, args, executable, env):
+        cache = self.COMPILE_CACHE
+
+        if cache is not None:
+            key = cache.key(
+                self._src_path, executable,
+                args + [self.target_filename])
+            cached = cache.get(key)
+
+            if cached is not None:
+                return self._restore(cached)
+
         self._copy_src(self.COMPILE_LEVEL)
 
         with open("/dev/null", "r") as stdin:
@@ -174,13 +375,17 @@ class CompilerMixin(object):
         code = p.wait()
 
         setfilecon(self._tempdir, self.filecon(self.RUN_LEVEL))
+        target = join(self._tempdir, self.target_filename)
 
         if code != EX_OK:
+            if cache is not None:
+                cache.put(key, code, stdout)
             return (code, stdout)
 
-        setfilecon(
-            join(self._tempdir, self.target_filename),
-            self.filecon(self.RUN_LEVEL))
+        setfilecon(target, self.filecon(self.RUN_LEVEL))
+
+        if cache is not None:
+            cache.put(key, code, stdout, target)
 
         return (code,)
 
@@ -0,0 +1,140 @@
+from fcntl import ioctl
+from multiprocessing import Queue
+from multiprocessing.util import Finalize
+import os
+from os.path import isdir, islink, join
+from Queue import Empty
+from shutil import copyfileobj, copymode, rmtree
+from tempfile import mkdtemp
+
+from selinux import setfilecon, setfscreatecon
+
+FICLONE = 0x40049409
+
+
+def stage(src, dst, filecon):
+    # never a hardlink, the sandbox is writable and chmod is not traced, so
+    # the original could be truncated through it.  A reflink shares the
+    # blocks but not the inode.
+    setfscreatecon(filecon)
+
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except IOError:
+                copyfileobj(fsrc, fdst)
+    finally:
+        setfscreatecon(None)
+
+    copymode(src, dst)
+
+
+class SandboxPool(object):
+
+    def __init__(self, root='/dev/shm', size=16, prefix="." + __package__):
+        self._root = root
+        self._size = size
+        self._prefix = prefix
+        self._pid = os.getpid()
+        self._free = {}
+        self._warm = {}
+        self._lent = set()
+        # a directory released by a process other than the one that
+        # acquired it, e.g. by a run stage worker, goes back through here
+        self._returns = Queue()
+
+    def _check_pid(self):
+        if os.getpid() == self._pid:
+            return
+
+        # directories inherited across fork belong to the parent, a worker
+        # warms its own and removes them when it exits
+        self._pid = os.getpid()
+        self._free = {}
+        self._lent = set()
+        Finalize(self, self.close, exitpriority=0)
+
+        for filecon, n in self._warm.items():
+            self.warm(filecon, n)
+
+    def _create(self, filecon):
+        setfscreatecon(filecon)
+
+        try:
+            return mkdtemp(prefix=self._prefix, dir=self._root)
+        finally:
+            setfscreatecon(None)
+
+    def warm(self, filecon, n=None):
+        self._check_pid()
+        self._warm[filecon] = n or self._size
+        free = self._free.setdefault(filecon, [])
+
+        while len(free) < (n or self._size):
+            free.append(self._create(filecon))
+
+    def _drain(self):
+        while True:
+            try:
+                path, filecon = self._returns.get_nowait()
+            except Empty:
+                return
+
+            free = self._free.setdefault(filecon, [])
+
+            if len(free) >= self._size:
+                rmtree(path, True)
+            else:
+                free.append(path)
+
+    def acquire(self, filecon):
+        self._check_pid()
+        self._drain()
+        free = self._free.get(filecon)
+        path = free.pop() if free else self._create(filecon)
+        self._lent.add(path)
+        return path
+
+    def _reset(self, path):
+        for name in os.listdir(path):
+            child = join(path, name)
+
+            if isdir(child) and not islink(child):
+                rmtree(child)
+            else:
+                os.unlink(child)
+
+    def release(self, path, filecon):
+        self._check_pid()
+
+        if path in self._lent:
+            self._lent.remove(path)
+            free = self._free.setdefault(filecon, [])
+        else:
+            free = None
+
+        if free is not None and len(free) >= self._size:
+            rmtree(path)
+            return
+
+        try:
+            self._reset(path)
+            setfilecon(path, filecon)
+        except OSError:
+            rmtree(path, True)
+            return
+
+        if free is None:
+            self._returns.put((path, filecon))
+        else:
+            free.append(path)
+
+    def close(self):
+        self._drain()
+
+        for free in self._free.values():
+            for path in free:
+                rmtree(path, True)
+
+        self._free = {}
@@ -0,0 +1,70 @@
+import json
+import os
+from os.path import dirname, exists
+from tempfile import mkstemp
+
+
+class TestScheduler(object):
+    # beta prior on the rejection rate of a test never seen before
+    PRIOR_FAILURES = 1.0
+    PRIOR_RUNS = 2.0
+    MIN_TIME = 0.001
+
+    def __init__(self, path=None):
+        self._path = path
+        self._history = {}
+
+        if path is not None and exists(path):
+            with open(path, 'rb') as f:
+                self._history = json.load(f)
+
+    def _tests(self, problem):
+        return self._history.setdefault(problem, {})
+
+    def record(self, problem, test, failed, cputime):
+        runs, failures, total = self._tests(problem).get(test, (0, 0, 0.0))
+        self._tests(problem)[test] = (
+            runs + 1, failures + int(failed), total + cputime)
+
+    def _expected_time(self, tests):
+        runs = sum(t[0] for t in tests.values())
+
+        if not runs:
+            return 1.0
+
+        return sum(t[2] for t in tests.values()) / runs
+
+    def score(self, problem, test):
+        tests = self._history.get(problem, {})
+        history = tests.get(test)
+
+        if history is None:
+            runs, failures = 0, 0
+            cputime = self._expected_time(tests)
+        else:
+            runs, failures, total = history
+            cputime = total / runs
+
+        rate = ((failures + self.PRIOR_FAILURES) /
+                (runs + self.PRIOR_RUNS))
+        return rate / max(cputime, self.MIN_TIME)
+
+    def order(self, problem, tests):
+        # most rejections per second first, ties in canonical order
+        return sorted(
+            range(len(tests)),
+            key=lambda i: (-self.score(problem, tests[i]), i))
+
+    def forget(self, problem):
+        self._history.pop(problem, None)
+
+    def save(self):
+        if self._path is None:
+            return
+
+        fd, tmp = mkstemp(prefix='.', dir=dirname(self._path) or '.')
+
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(self._history, f)
+
+        os.rename(tmp, self._path)
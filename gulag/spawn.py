@@ -0,0 +1,212 @@
+from ctypes import (
+    CDLL, POINTER, Structure, byref, c_char_p, c_int, c_ulong, c_void_p)
+from errno import ECHILD, EINVAL
+from fcntl import fcntl, F_GETFD, F_SETFD, FD_CLOEXEC
+from imp import get_suffixes, C_EXTENSION
+import os
+from os.path import dirname, isfile, join
+from resource import setrlimit
+from signal import SIGKILL, SIGSTOP, SIGTRAP
+from subprocess import MAXFD
+
+from .compat import (
+    traceme, cont, set_options, install_filter, PTRACE_EVENT_SECCOMP)
+
+
+# built by setup.py, see the ext_modules there
+LIBRARIES = [
+    join(dirname(__file__), '_spawn' + suffix)
+    for suffix, _, kind in get_suffixes() if kind == C_EXTENSION]
+
+
+class gulag_rlimit(Structure):
+    _fields_ = (
+        ('resource', c_int),
+        ('soft',     c_ulong),
+        ('hard',     c_ulong))
+
+
+_lib = None
+
+
+def load():
+    global _lib
+
+    if _lib is None:
+        _lib = _load() or False
+
+    return _lib or None
+
+
+def _load():
+    for path in LIBRARIES:
+        if isfile(path):
+            break
+    else:
+        return None
+
+    try:
+        lib = CDLL(path)
+    except OSError:
+        return None
+
+    lib.gulag_spawn.argtypes = [
+        c_char_p, POINTER(c_char_p), POINTER(c_char_p),
+        c_char_p, c_int, c_int, c_int,
+        POINTER(gulag_rlimit), c_int,
+        c_char_p, c_void_p,
+        c_int, POINTER(c_int)]
+    lib.gulag_spawn.restype = c_int
+    return lib
+
+
+def resolve(executable, env, cwd=None):
+    # same lookup as os.execvpe, relative to the child's cwd
+    if '/' in executable:
+        return executable
+
+    for d in env.get('PATH', os.defpath).split(':'):
+        path = join(d, executable)
+
+        if cwd is not None:
+            path = join(cwd, path)
+
+        # execve only needs x for us, not for everyone
+        if isfile(path) and os.access(path, os.X_OK):
+            return path
+
+    raise OSError(2, "No such file or directory", executable)
+
+
+def spawn(lib, executable, args, env, cwd, fds, rlimits,
+          cgroup_procs=None, seccomp_filter=None, options=0):
+    if lib is None:
+        return spawn_fork(
+            executable, args, env, cwd, fds, rlimits,
+            cgroup_procs, seccomp_filter, options)
+
+    argv = (c_char_p * (len(args) + 1))(*args)
+    envp = ["%s=%s" % item for item in env.items()]
+    envp = (c_char_p * (len(envp) + 1))(*envp)
+    limits = (gulag_rlimit * len(rlimits))(*[
+        (resource, int(soft), int(hard))
+        for resource, soft, hard in rlimits])
+    error = c_int()
+
+    pid = lib.gulag_spawn(
+        resolve(executable, env, cwd), argv, envp,
+        cwd, fds[0], fds[1], fds[2],
+        limits, len(rlimits),
+        cgroup_procs,
+        None if seccomp_filter is None else byref(seccomp_filter),
+        options, byref(error))
+
+    if pid < 0:
+        raise OSError(error.value, os.strerror(error.value))
+
+    return pid
+
+
+def _child(executable, args, env, cwd, fds, rlimits,
+           cgroup_procs, seccomp_filter, errpipe):
+    for i, fd in enumerate(fds):
+        if fd < 0:
+            continue
+
+        # dup2 onto itself would keep FD_CLOEXEC
+        if fd == i:
+            fcntl(i, F_SETFD, fcntl(i, F_GETFD) & ~FD_CLOEXEC)
+        else:
+            os.dup2(fd, i)
+
+    os.closerange(3, errpipe)
+    os.closerange(errpipe + 1, MAXFD)
+
+    if cwd is not None:
+        os.chdir(cwd)
+
+    if cgroup_procs is not None:
+        with open(cgroup_procs, 'w') as f:
+            f.write("0")
+
+    for resource, soft, hard in rlimits:
+        setrlimit(resource, (soft, hard))
+
+    if traceme() != 0:
+        raise OSError(EINVAL, "PTRACE_TRACEME failed")
+
+    # see _spawn.c, the filter waits until the tracer has set its options
+    os.kill(os.getpid(), SIGSTOP)
+
+    if seccomp_filter is not None:
+        install_filter(seccomp_filter)
+
+    os.execve(executable, args, env)
+
+
+def _trace_exec(pid, options):
+    # 0 once stopped at exec with options set, 1 if reaped, -1 otherwise
+    _, status = os.waitpid(pid, 0)
+
+    if not os.WIFSTOPPED(status):
+        return 1
+
+    if os.WSTOPSIG(status) != SIGSTOP:
+        return -1
+
+    set_options(pid, options)
+
+    while True:
+        if cont(pid) != 0:
+            return -1
+
+        _, status = os.waitpid(pid, 0)
+
+        if not os.WIFSTOPPED(status):
+            return 1
+
+        if (os.WSTOPSIG(status) == SIGTRAP and
+                status >> 16 != PTRACE_EVENT_SECCOMP):
+            return 0
+
+
+def spawn_fork(executable, args, env, cwd, fds, rlimits,
+               cgroup_procs=None, seccomp_filter=None, options=0):
+    # the same steps as _spawn.c, for when it cannot be built
+    executable = resolve(executable, env, cwd)
+    errread, errwrite = os.pipe()
+    fcntl(errwrite, F_SETFD, FD_CLOEXEC)
+
+    try:
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                _child(executable, args, env, cwd, fds, rlimits,
+                       cgroup_procs, seccomp_filter, errwrite)
+            except BaseException as e:
+                os.write(errwrite, str(getattr(e, 'errno', None) or EINVAL))
+            finally:
+                os._exit(127)
+
+        os.close(errwrite)
+        errwrite = None
+
+        traced = _trace_exec(pid, options)
+
+        if traced < 0:
+            os.kill(pid, SIGKILL)
+            os.waitpid(pid, 0)
+
+        # the pipe closes on exec, anything in it is an errno
+        data = os.read(errread, 32)
+    finally:
+        os.close(errread)
+        if errwrite is not None:
+            os.close(errwrite)
+
+    if traced != 0:
+        errno = int(data) if data else ECHILD
+        raise OSError(errno, os.strerror(errno))
+
+    return pid
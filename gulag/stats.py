@@ -0,0 +1,48 @@
+from collections import Counter
+
+
+hooks = []
+
+
+def add_hook(hook):
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+def run_hooks(stats):
+    for hook in hooks:
+        hook(stats)
+
+
+class TraceStats(object):
+
+    def __init__(self):
+        self.stops = 0
+        self.syscalls = Counter()
+        self.statm_reads = 0
+        self.tracer_time = 0.0
+        self.output_bytes = 0
+        self.stderr_bytes = 0
+        self.wall_time = None
+        self.accounting = None
+        self.threads = 1
+
+    def as_dict(self):
+        return {
+            'stops': self.stops,
+            'syscalls': dict(self.syscalls),
+            'statm_reads': self.statm_reads,
+            'tracer_time': self.tracer_time,
+            'output_bytes': self.output_bytes,
+            'stderr_bytes': self.stderr_bytes,
+            'wall_time': self.wall_time,
+            'accounting': self.accounting,
+            'threads': self.threads,
+        }
+
+    def __repr__(self):
+        return "<TraceStats stops=%d tracer_time=%.6f wall_time=%r>" % (
+            self.stops, self.tracer_time, self.wall_time)
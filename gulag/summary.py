@@ -0,0 +1,66 @@
+from collections import namedtuple
+from math import sqrt
+
+
+Summary = namedtuple(
+    'Summary',
+    'n mean median stdev variance min max percentiles')
+
+# two-sided 95% critical values of Student's t, by degrees of freedom
+T95 = [
+    None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+    2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093,
+    2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045,
+    2.042]
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+
+    k = (len(ordered) - 1) * p / 100.0
+    i = int(k)
+
+    if i + 1 >= len(ordered):
+        return ordered[-1]
+
+    return ordered[i] + (ordered[i + 1] - ordered[i]) * (k - i)
+
+
+def summarize(samples, percentiles=(50, 90, 99)):
+    n = len(samples)
+    ordered = sorted(samples)
+    mean = float(sum(ordered)) / n
+    variance = sum((x - mean) ** 2 for x in ordered) / max(n - 1, 1)
+
+    return Summary(
+        n, mean, percentile(ordered, 50), sqrt(variance), variance,
+        ordered[0], ordered[-1],
+        dict((p, percentile(ordered, p)) for p in percentiles))
+
+
+def confidence_halfwidth(summary):
+    if summary.n < 2:
+        return float('inf')
+
+    df = summary.n - 1
+    t = T95[df] if df < len(T95) else 1.960
+    return t * summary.stdev / sqrt(summary.n)
+
+
+class Benchmark(namedtuple(
+        'Benchmark', 'cputime rss vm warmup halfwidth converged')):
+
+    __slots__ = ()
+
+    @property
+    def times(self):
+        return self.cputime.n
+
+    def limits(self, p=None):
+        if p is None:
+            return self.cputime.median, self.rss.median, self.vm.median
+
+        return (self.cputime.percentiles[p],
+                self.rss.percentiles[p],
+                self.vm.percentiles[p])
@@ -0,0 +1,124 @@
+from hashlib import sha1
+import os
+from os.path import basename, join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from selinux import getfilecon, setfilecon
+
+from .runner import check_category
+from .sandbox import stage
+
+
+class _Entry(object):
+    __slots__ = ('path', 'served', 'size', 'checked', 'problems')
+
+    def __init__(self, path, served, size):
+        self.path = path
+        self.served = served
+        self.size = size
+        self.checked = set()
+        self.problems = set()
+
+
+class TestDataStore(object):
+    HOT_FILE_LIMIT = 1 << 20
+
+    def __init__(self, hot_root='/dev/shm', hot_limit=64 << 20,
+                 prefix="." + __package__):
+        self._hot_root = hot_root
+        self._hot_limit = hot_limit
+        self._hot_size = 0
+        self._prefix = prefix
+        self._hotdir = None
+        self._files = {}
+        self._problems = {}
+
+    def _hot_copy(self, path, size, filecon):
+        if size > self.HOT_FILE_LIMIT:
+            return None
+
+        if self._hot_size + size > self._hot_limit:
+            return None
+
+        if self._hotdir is None:
+            self._hotdir = mkdtemp(prefix=self._prefix, dir=self._hot_root)
+
+        served = join(
+            self._hotdir,
+            "%s-%s" % (sha1(path).hexdigest()[:16], basename(path)))
+        stage(path, served, filecon)
+        self._hot_size += size
+        return served
+
+    def _add(self, path, filecon):
+        entry = self._files.get(path)
+
+        if entry is None:
+            size = os.stat(path).st_size
+            served = self._hot_copy(path, size, filecon) or path
+            entry = self._files[path] = _Entry(path, served, size)
+
+        self._check(entry, filecon)
+        return entry
+
+    def _check(self, entry, filecon):
+        if filecon in entry.checked:
+            return
+
+        if check_category(filecon, getfilecon(entry.served)[1]):
+            setfilecon(entry.served, filecon)
+
+        entry.checked.add(filecon)
+
+    def register(self, problem, testcases, filecon):
+        self.unregister(problem)
+
+        for testcase in testcases:
+            for path in testcase:
+                if path is not None:
+                    self._add(path, filecon).problems.add(problem)
+
+        self._problems[problem] = list(testcases)
+        return self._problems[problem]
+
+    def testcases(self, problem):
+        return self._problems.get(problem)
+
+    def unregister(self, problem):
+        for testcase in self._problems.pop(problem, ()):
+            for path in testcase:
+                entry = self._files.get(path)
+
+                if entry is None:
+                    continue
+
+                entry.problems.discard(problem)
+
+                if not entry.problems:
+                    self._remove(entry)
+
+    def _remove(self, entry):
+        del self._files[entry.path]
+
+        if entry.served != entry.path:
+            os.unlink(entry.served)
+            self._hot_size -= entry.size
+
+    def open(self, path, filecon):
+        entry = self._files.get(path)
+
+        if entry is None:
+            return None
+
+        self._check(entry, filecon)
+        return open(entry.served, 'rb')
+
+    def close(self):
+        if self._hotdir is not None:
+            rmtree(self._hotdir, True)
+
+        self._hotdir = None
+        self._hot_size = 0
+        self._files = {}
+        self._problems = {}
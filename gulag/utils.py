@@ -1,3 +1,4 @@
+from collections import deque
 import os
 import os.path
 import stat
@@ -21,3 +22,21 @@ def which(name, PATH=None):
             return fullname
         except OSError:
             continue
+
+
+class TailBuffer(object):
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._chunks = deque()
+        self._size = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+
+        while self._size - len(self._chunks[0]) >= self._limit:
+            self._size -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        return ''.join(self._chunks)[-self._limit:]
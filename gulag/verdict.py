@@ -12,7 +12,7 @@ RF = 10
 CJ = 11
 
 verdictcode = [
-    'QU', 'AC', 'PE', 'WA', 'CE', 'RE'
+    'QU', 'AC', 'PE', 'WA', 'CE', 'RE',
     'TL', 'ML', 'OL', 'SE', 'RF', 'CJ']
 
 verdicttext = [
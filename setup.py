@@ -1,9 +1,9 @@
 #!/usr/bin/env python2
 
 try:
-    from setuptools import setup
+    from setuptools import setup, Extension
 except ImportError:
-    from distutils.core import setup
+    from distutils.core import setup, Extension
 
 setup(
     name = 'gulag',
@@ -24,5 +24,11 @@ setup(
     author = 'bhuztez',
     author_email = 'bhuztez@gmail.com',
 
-    packages = ['gulag'],
+    packages = ['gulag', 'gulag.bench'],
+    package_data = {
+        'gulag.bench': ['programs/*.c']},
+
+    # loaded with ctypes, not imported, spawn.py falls back to fork without it
+    ext_modules = [
+        Extension('gulag._spawn', ['gulag/_spawn.c'])],
 )